@@ -3,97 +3,101 @@
 import argparse
 import json
 import logging
-import os
 import sys
 try:
     from .core import *
+    from .engine import Facture
 except ImportError:
     from core import *
+    from engine import Facture
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-v', action="count", default=0)
 parser.add_argument('--conf-dir', type=str)
-parser.add_argument('--output-type', type=str, choices=['json', 'sql'])
+parser.add_argument('--output-type', type=str, choices=['json', 'sql'],
+                    help="print the data as json, or as a SQL load script in FK order")
 parser.add_argument('--skip-targets', action="store_true")
 parser.add_argument('--flexible-group-names', action="store_true")
-args = parser.parse_args()
+parser.add_argument('--jobs', type=int, default=1,
+                    help="render and write independent target files with this many workers")
+parser.add_argument('--marker-cache', type=str,
+                    help="cache the facture_json markers of target files in this file between runs")
+parser.add_argument('--partition-dir', type=str,
+                    help="also write each group as its own files, with a manifest, "
+                         "to this directory")
+parser.add_argument('--id-manifest', type=str,
+                    help="write the generated ids to this binary manifest when they change")
+parser.add_argument('--groups', type=str, nargs='+',
+                    help="only generate the groups matching these glob patterns")
+parser.add_argument('--seed', type=int, default=0,
+                    help="seed for the values of attrs with a 'gen' spec")
+parser.add_argument('--offset-alignment', type=int, default=1,
+                    help="align the offsets of groups with 'offset': 'auto' to multiples of this")
+parser.add_argument('--offset-lock', type=str,
+                    help="keep auto offsets stable in this file"
+                         " (default: facture_offsets.lock.json in the conf dir)")
+parser.add_argument('--spill-threshold', type=int,
+                    help="move the rendered rows of a target to a temporary file"
+                         " once they exceed this many characters")
+parser.add_argument('--delta-state', type=str,
+                    help="print the SQL that updates a database loaded by the run saved in this"
+                         " state file, then save this run there")
+parser.add_argument('--per-group-sequences', action="store_true",
+                    help="start the sequences of each group over at start + offset")
+parser.add_argument('--sink', type=str, action='append', default=[],
+                    help="also write the records as format:path, where the format is sql, csv"
+                         " (path is a directory) or json (lines), and a path of - is stdout."
+                         " Can be given more than once")
+parser.add_argument('--bulk-load', type=str, choices=sorted(BULK_LOAD_DIALECTS),
+                    help="wrap SQL load scripts in this dialect's statements for fast bulk loads")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    if args.v >= 2:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.v >= 1:
+        logging.basicConfig(level=logging.INFO)
+
+    facture = Facture.from_conf_dir(
+        args.conf_dir,
+        flexible_group_names=args.flexible_group_names,
+        marker_cache_path=args.marker_cache,
+        offset_alignment=args.offset_alignment,
+        offset_lock_path=args.offset_lock,
+        seed=args.seed,
+        groups=args.groups,
+        spill_threshold=args.spill_threshold,
+        per_group_sequences=args.per_group_sequences,
+    )
+
+    d = facture.generate()
+
+    if args.partition_dir:
+        facture.write_group_partitions(args.partition_dir)
+
+    if args.id_manifest:
+        facture.write_id_manifest(args.id_manifest)
 
-if args.v >= 2:
-    logging.basicConfig(level=logging.DEBUG)
-elif args.v >= 1:
-    logging.basicConfig(level=logging.INFO)
-
-
-
-if args.conf_dir:
-    if not os.path.isdir(args.conf_dir):
-        raise ConfError("conf-dir {} does not exist".format(args.conf_dir))
-    sys.path.insert(0, args.conf_dir)
-else:
-    if not os.path.isfile("factureconf.py"):
-        raise ConfError("Either put a factureconf.py file in this directory or set --conf-dir")
-    else:
-        sys.path.insert(0, os.getcwd())
-
-import factureconf # noqa
-
-
-def main():
-    seq_for = {}
-
-    logging.debug("setting up data")
-
-    conf_tables = factureconf.conf_tables()
-
-    d = factureconf.conf_data()
-
-    d = normalize_structure(d)
-
-    consistency_checks_or_immediately_die(d, flexible_group_names=args.flexible_group_names)
-
-    logging.debug("generating data")
-
-    d = enhance_with_generated_data(d, seq_for, conf_tables)
-
-    d = add_table_defaults(d, conf_tables)
-
-    d = combine_all_into_result(d)
-
-    logging.debug("adding sql output")
-
-    d = add_sql_output(d, conf_tables)
+    if args.output_type and args.output_type == 'json':
+        print(json.dumps(d, indent=4, sort_keys=True, default=json_default))
 
-    logging.debug("annotating with target information")
+    if args.output_type and args.output_type == 'sql':
+        for chunk in facture.load_script_chunks(args.bulk_load):
+            sys.stdout.write(chunk)
 
-    targets = factureconf.conf_targets()
-    targets = annotate_targets_with_positional_data_from_file(targets)
-    d = add_target_info(d, conf_tables, targets)
+    if args.sink:
+        facture.write_sinks(args.sink, args.bulk_load)
 
-    if args.output_type and args.output_type == 'json':
-        print(json.dumps(d, indent=4, sort_keys=True, default=str))
+    if args.delta_state:
+        facture.write_delta(args.delta_state, sys.stdout)
 
     if args.skip_targets:
         logging.debug("skipping exporting to targets because of --skip-targets")
     else:
-        logging.debug("exporting to targets")
-        if len(targets) < 1:
-            raise ConfError(
-                "You have no targets specified in the conf_targets function."
-                " Use --skip-targets if that is intentional."
-            )
-
-        targets = annotate_targets_with_output_values(targets, d)
-        write_to_actual_target_files(targets)
-
-
-#############################################################################
-
-
-def config_for(table):
-    return factureconf.conf_tables()[table]
-
+        facture.write(jobs=args.jobs)
 
-seq_for = None
 
 if __name__ == '__main__':
     main()
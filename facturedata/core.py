@@ -1,9 +1,35 @@
+import bz2
 import copy
+import csv
+import datetime
+import decimal
+import gzip
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
 import re
 import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import json
+import lzma
+import os
+import shutil
+import struct
 import sys
+import tempfile
 from abc import abstractmethod
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ordered_dict_version = (3, 6)
 HAS_DEFAULT_ORDERED_DICT = sys.version_info > ordered_dict_version
@@ -41,16 +67,209 @@ class FactureRefObj:
         """
         pass
 
+    def bind_many(self, values):
+        """
+        Binds evaluated values to many anchors at once
+        :param values: dict[str, any], facture anchor to resolved facture reference
+        :return: void
+        """
+        for anchor, value in values.items():
+            self.bind(anchor, value)
+
+
+ANCHOR_PATTERN = re.compile(r'facture_anchor\{([^}]+)\}')
+
+
+@functools.lru_cache(maxsize=None)
+def parse_anchor_template(template):
+    """Split a template into literal text and anchors.  Cached by template source.
+
+    Literal text is at the even indexes of the parts and anchors at the odd ones.
+
+    >>> template = 'id = facture_anchor{.p.id} or facture_anchor{.p.id}'
+    >>> parts, anchors = parse_anchor_template(template)
+    >>> parts
+    ('id = ', '.p.id', ' or ', '.p.id', '')
+    >>> anchors
+    ('.p.id',)
+    """
+
+    parts = tuple(ANCHOR_PATTERN.split(template))
+    anchors = tuple(collections.OrderedDict.fromkeys(parts[1::2]))
+    return parts, anchors
+
+
+class TemplateRefObj(FactureRefObj):
+    """A string template that references facture anchors like facture_anchor{.p_1.id}
+
+    >>> t = TemplateRefObj('select * from orders where product_id = facture_anchor{.p_1.id}')
+    >>> t.anchors()
+    ['.p_1.id']
+    >>> t.bind_many({'.p_1.id': 1100})
+    >>> t.eval()
+    'select * from orders where product_id = 1100'
+
+    >>> TemplateRefObj('facture_anchor{.x.id}').eval()
+    Traceback (most recent call last):
+    core.ConfError: anchor ".x.id" is not bound in template "facture_anchor{.x.id}"
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._parts, self._anchors = parse_anchor_template(template)
+        self.anchor_values = {}
+
+    def anchors(self):
+        return list(self._anchors)
+
+    def bind(self, anchor, value):
+        self.anchor_values[anchor] = value
+
+    def bind_many(self, values):
+        self.anchor_values.update(values)
+
+    def eval(self):
+        parts = list(self._parts)
+        for index in range(1, len(parts), 2):
+            value = self.anchor_values.get(parts[index])
+            if value is None:
+                raise ConfError('anchor "{}" is not bound in template "{}"'.format(
+                    parts[index], self.template
+                ))
+            parts[index] = str(value)
+        return ''.join(parts)
+
 
 class ConfError(Exception):
     pass
 
 
 def normalize_structure(data):
-    data = normalize_structure_copy_raw(data)
+    """Normalize the groups.  The groups stamped out of one group template
+    share its data, which is normalized once for all of them.
+    """
 
-    data = normalize_structure_ensure_dictionaries(data)
-    return data
+    plain = [x for x in data if 'params' not in x]
+    plain = normalize_structure_copy_raw(plain)
+    plain = iter(normalize_structure_ensure_dictionaries(plain))
+
+    normalized_templates = {}
+    result = []
+    for x in data:
+        if 'params' not in x:
+            result.append(next(plain))
+            continue
+        key = id(x['data'])
+        if key not in normalized_templates:
+            template = normalize_structure_copy_raw([{'data': x['data']}])
+            normalized_templates[key] = normalize_structure_ensure_dictionaries(template)[0]['data']
+        result.append(stamp_group_template(x, normalized_templates[key]))
+    return result
+
+
+class TemplateParam:
+    """An attr value of a group template that comes from the params of each
+    group stamped out of it: either the name of a param, or a function of
+    the params dict.
+
+    >>> TemplateParam('currency').value({'currency': 'eur'})
+    'eur'
+    >>> TemplateParam(lambda p: p['qty'] * 2).value({'qty': 3})
+    6
+    """
+
+    def __init__(self, name_or_function):
+        self.name_or_function = name_or_function
+
+    def value(self, params):
+        if callable(self.name_or_function):
+            return self.name_or_function(params)
+        if self.name_or_function not in params:
+            raise ConfError('group template has no param "{}"'.format(self.name_or_function))
+        return params[self.name_or_function]
+
+
+def expand_group_templates(data):
+    """Expand the group templates in conf_data() into groups.
+
+    All the groups are made up front, because packing offsets and selecting
+    --groups need every group.  The groups of a template share its raw data,
+    so normalize_structure only normalizes it once.
+
+    A group template has 'params': either a dict of param name to values,
+    which is expanded into every combination like a parametrize matrix, or a
+    list of params dicts.  Its 'group' is formatted with the params of each
+    group.  With an integer 'offset', the groups get offsets spaced by
+    'offset_step', which defaults to the most records of one table in the
+    template.  With 'offset': 'auto', they are packed like other auto groups.
+
+    >>> template = {'group': 'facture_group_{currency}_{qty}', 'offset': 100,
+    ...             'params': {'currency': ['usd', 'eur'], 'qty': [1, 5]},
+    ...             'data': [['orders o', {'attrs': {'qty': TemplateParam('qty')}}], ['items i']]}
+    >>> for x in expand_group_templates([template]):
+    ...     print(x['group'], x['offset'])
+    facture_group_usd_1 100
+    facture_group_usd_5 101
+    facture_group_eur_1 102
+    facture_group_eur_5 103
+
+    >>> repeating = dict(template, group='facture_group_x')
+    >>> list(expand_group_templates([repeating]))  # doctest: +NORMALIZE_WHITESPACE
+    Traceback (most recent call last):
+    core.ConfError: group template "facture_group_x" makes the group "facture_group_x"
+        more than once
+    """
+
+    for x in data:
+        if 'params' not in x:
+            yield x
+            continue
+
+        params = x['params']
+        if isinstance(params, dict):
+            names = list(params)
+            param_sets = (dict(zip(names, v)) for v in itertools.product(*params.values()))
+        else:
+            param_sets = iter(params)
+
+        offset = x.get('offset', 'auto')
+        step = x.get('offset_step')
+        if step is None and offset != 'auto':
+            step = max(list(raw_table_counts(x).values()) or [1])
+
+        names_seen = set()
+        for index, param_set in enumerate(param_sets):
+            name = x['group'].format(**param_set)
+            if name in names_seen:
+                raise ConfError('group template "{}" makes the group "{}" more than once'.format(
+                    x['group'], name
+                ))
+            names_seen.add(name)
+            group = {k: v for k, v in x.items() if k not in ('params', 'offset_step')}
+            group.update(
+                group=name,
+                offset=offset if offset == 'auto' else offset + index * step,
+                params=param_set,
+            )
+            yield group
+
+
+def stamp_group_template(group, template_data):
+    """A normalized group from the normalized data of its template, with the
+    TemplateParam attrs set from the params of the group"""
+
+    params = group['params']
+    result = {k: v for k, v in group.items() if k not in ('data', 'params')}
+    result['data'] = []
+    for y in template_data:
+        raw = dict(y['raw'])
+        raw['attrs'] = {
+            k: v.value(params) if isinstance(v, TemplateParam) else v
+            for k, v in raw['attrs'].items()
+        }
+        raw['ref_objs'] = copy.deepcopy(raw['ref_objs'])
+        result['data'].append(dict(y, raw=raw))
+    return result
 
 
 def normalize_structure_copy_raw(data):
@@ -68,6 +287,9 @@ def normalize_structure_copy_raw(data):
         for y in x['data']:
             if len(y) == 1:
                 y.append({})
+            if 'repeat' in y[1]:
+                new_data.extend({'raw': raw} for raw in expand_repeated_entry(y[0], y[1]))
+                continue
             raw = {'tablestr': y[0]}
             raw.update({'attrs': y[1].get('attrs', {})})
             raw.update({'refs': y[1].get('refs', {})})
@@ -77,6 +299,63 @@ def normalize_structure_copy_raw(data):
     return result
 
 
+def expand_repeated_entry(tablestr, opts):
+    """Expand a data entry with a 'repeat' option into one raw record per index.
+
+    The alias of each record gets the index appended, so "orders o" becomes
+    "orders o[0]", "orders o[1]", etc.  Callable attrs are called with the
+    index, and "[i]" in a refstr points at the record with the same index in
+    another repeated entry.
+
+    >>> opts = {'repeat': 2,
+    ...         'attrs': {'name': lambda i: 'order {}'.format(i), 'kind': 'web'},
+    ...         'refs': {'customer_id': '.c.id', 'product_id': '.p[i].id'}}
+    >>> records = list(expand_repeated_entry('orders o', opts))
+    >>> [r['tablestr'] for r in records]
+    ['orders o[0]', 'orders o[1]']
+    >>> records[1]['attrs'] == {'name': 'order 1', 'kind': 'web'}
+    True
+    >>> records[1]['refs'] == {'customer_id': '.c.id', 'product_id': '.p[1].id'}
+    True
+
+    A callable repeat yields per-record attrs, one record per item.
+
+    >>> opts = {'repeat': lambda: ({'name': n} for n in ['a', 'b', 'c'])}
+    >>> [r['attrs']['name'] for r in expand_repeated_entry('orders o', opts)]
+    ['a', 'b', 'c']
+
+    >>> list(expand_repeated_entry('orders o', {'repeat': -1}))
+    Traceback (most recent call last):
+    core.ConfError: in "data", "orders o" has an invalid repeat: -1
+    """
+
+    repeat = opts['repeat']
+    if callable(repeat):
+        per_record_attrs = repeat()
+    elif isinstance(repeat, int) and repeat >= 0:
+        per_record_attrs = ({} for _ in range(repeat))
+    else:
+        raise ConfError('in "data", "{}" has an invalid repeat: {!r}'.format(tablestr, repeat))
+
+    attrs = opts.get('attrs', {})
+    refs = opts.get('refs', {})
+    ref_objs = opts.get('ref_objs', {})
+
+    for index, extra_attrs in enumerate(per_record_attrs):
+        record_attrs = {k: v(index) if callable(v) else v for k, v in attrs.items()}
+        record_attrs.update(extra_attrs)
+        yield {
+            'tablestr': '{}[{}]'.format(tablestr, index),
+            'attrs': record_attrs,
+            'refs': {
+                k: v.replace('[i]', '[{}]'.format(index)) for k, v in refs.items()
+            },
+            'ref_objs': {
+                k: v(index) if callable(v) else copy.deepcopy(v) for k, v in ref_objs.items()
+            },
+        }
+
+
 def normalize_structure_ensure_dictionaries(data):
     """This adds dictionaries to each of the 'data' list items.
 
@@ -142,6 +421,263 @@ def consistency_check_offset(data):
         raise ConfError('These offsets are duplicated: {}'.format(dups))
 
 
+def resolve_auto_offsets(data, table_config, alignment=1, locked=None, per_group=False):
+    """Give every group with 'offset': 'auto' an offset, packing the groups
+    into dense, non-overlapping id ranges.
+
+    Groups with explicit offsets keep them.  Offsets in locked (a dict of group
+    name to offset, usually from a previous run) are kept when they are still
+    aligned and still fit.  Returns the data and the auto offsets.
+
+    It works on the data as it comes from conf_data(), before normalization.
+    With per_group, the ids of each group are packed as numbered by
+    enhance_with_generated_sequential_data with per_group.
+
+    >>> config = {'t': {'attrs': {'id': {'seq': {'start': 100}}}}}
+    >>> d = [{'group': 'a', 'offset': 'auto', 'data': [['t x', {'repeat': 3}]]},
+    ...      {'group': 'b', 'offset': 0, 'data': [['t x'], ['t y']]},
+    ...      {'group': 'c', 'offset': 'auto', 'data': [['t x'], ['t y']]}]
+    >>> result, assignments = resolve_auto_offsets(d, config, alignment=10)
+    >>> assignments == {'a': 10, 'c': 20}
+    True
+    >>> [x['offset'] for x in result]
+    [10, 0, 20]
+
+    The ids of a are 110-112, those of b 103-104 and those of c 125-126.
+
+    >>> result, assignments = resolve_auto_offsets(d, config, alignment=10, locked={'c': 50})
+    >>> assignments == {'a': 10, 'c': 50}
+    True
+
+    >>> result, assignments = resolve_auto_offsets(d, config, alignment=10, per_group=True)
+    >>> assignments == {'a': 10, 'c': 20}
+    True
+    """
+
+    result = copy.deepcopy(data)
+    locked = locked or {}
+
+    counters = collections.Counter()
+    ranges_for = []
+    for x in result:
+        ranges = {}
+        for table, count in raw_table_counts(x).items():
+            if table not in table_config:
+                continue
+            for attr in attributes_needing_sequences(table_config[table]):
+                start = table_config[table]['attrs'][attr]['seq']['start']
+                used = 0 if per_group else counters[(table, attr)]
+                ranges[(table, attr)] = (start + used, count)
+                counters[(table, attr)] += count
+        ranges_for.append(ranges)
+
+    occupied = collections.defaultdict(list)
+    used_offsets = set()
+
+    def fits(offset, ranges):
+        if offset in used_offsets:
+            return False
+        for key, (base, count) in ranges.items():
+            lo, hi = base + offset, base + offset + count
+            if any(lo < o_hi and o_lo < hi for o_lo, o_hi in occupied[key]):
+                return False
+        return True
+
+    def place(offset, ranges):
+        used_offsets.add(offset)
+        for key, (base, count) in ranges.items():
+            occupied[key].append((base + offset, base + offset + count))
+
+    def align_up(value):
+        return -(-value // alignment) * alignment
+
+    def lowest_fitting_offset(ranges):
+        candidates = {0}
+        for key, (base, count) in ranges.items():
+            candidates.update(align_up(max(0, o_hi - base)) for o_lo, o_hi in occupied[key])
+        for candidate in sorted(candidates):
+            while candidate in used_offsets:
+                candidate += alignment
+            if fits(candidate, ranges):
+                return candidate
+
+    auto = []
+    for x, ranges in zip(result, ranges_for):
+        if x['offset'] == 'auto':
+            auto.append((x, ranges))
+        else:
+            place(x['offset'], ranges)
+
+    assignments = {}
+    for x, ranges in auto:
+        offset = locked.get(x['group'])
+        if offset is not None and offset % alignment == 0 and fits(offset, ranges):
+            assignments[x['group']] = offset
+            place(offset, ranges)
+
+    for x, ranges in auto:
+        if x['group'] not in assignments:
+            assignments[x['group']] = lowest_fitting_offset(ranges)
+            place(assignments[x['group']], ranges)
+        x['offset'] = assignments[x['group']]
+
+    return result, assignments
+
+
+def raw_table_counts(group):
+    """Count the records of each table in a group as it comes from conf_data(),
+    without normalizing it
+
+    >>> g = {'data': [['films f'], ['roles r', {'repeat': 3}], ['roles x', {}]]}
+    >>> raw_table_counts(g) == {'films': 1, 'roles': 4}
+    True
+    """
+
+    counts = collections.Counter()
+    for y in group['data']:
+        table = y[0].split(' ')[0]
+        repeat = y[1].get('repeat') if len(y) > 1 else None
+        if repeat is None:
+            counts[table] += 1
+        elif callable(repeat):
+            counts[table] += sum(1 for _ in repeat())
+        else:
+            counts[table] += repeat
+    return counts
+
+
+def select_groups(data, patterns, table_config):
+    """Keep the groups whose names match one of the glob patterns.
+
+    Also returns, for each kept group, how many records of each table with a
+    sequence come before it, so the kept groups get the same ids as in a
+    full run.
+
+    >>> config = {'t': {'attrs': {'id': {'seq': {'start': 1}}}}, 'u': {'attrs': {}}}
+    >>> d = [{'group': 'facture_group_a', 'data': [['t x'], ['t y'], ['u z']]},
+    ...      {'group': 'facture_group_b', 'data': [['t x']]}]
+    >>> selected, bases = select_groups(d, ['*_b'], config)
+    >>> [x['group'] for x in selected], bases
+    (['facture_group_b'], {'facture_group_b': {'t': 2}})
+
+    >>> select_groups(d, ['*_c'], config)
+    Traceback (most recent call last):
+    core.ConfError: no groups match --groups *_c
+    """
+
+    selected = []
+    bases = {}
+    counts = collections.Counter()
+    for x in data:
+        if any(fnmatch.fnmatchcase(x['group'], pattern) for pattern in patterns):
+            selected.append(x)
+            bases[x['group']] = dict(counts)
+        for table, count in raw_table_counts(x).items():
+            if table in table_config and attributes_needing_sequences(table_config[table]):
+                counts[table] += count
+
+    if not selected:
+        raise ConfError('no groups match --groups {}'.format(' '.join(patterns)))
+    return selected, bases
+
+
+def load_offset_lock(path, alignment):
+    """ The locked offsets, or none when the lock is missing or was made with
+    another alignment
+    """
+
+    try:
+        with open(path, 'r') as f:
+            lock = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if lock.get('alignment') != alignment:
+        return {}
+    return lock.get('offsets', {})
+
+
+def save_offset_lock(path, alignment, assignments):
+    with open(path, 'w') as f:
+        lock = {'alignment': alignment, 'offsets': assignments}
+        f.write(json.dumps(lock, indent=4, sort_keys=True))
+        f.write('\n')
+
+
+def consistency_check_no_duplicate_generated_values(data):
+    """Check that no two records got the same generated value, which happens
+    when the id ranges of groups overlap
+
+    >>> d = [{'group': 'a', 'data': [{'table': 't', 'generated': {'id': 5}}]},
+    ...      {'group': 'b', 'data': [{'table': 't', 'generated': {'id': 5}}]}]
+    >>> consistency_check_no_duplicate_generated_values(d)
+    Traceback (most recent call last):
+    core.ConfError: t.id 5 is generated in both group "a" and group "b", so their offsets overlap
+    """
+
+    group_for = {}
+    for x in data:
+        for y in x['data']:
+            for attr, value in y['generated'].items():
+                key = (y['table'], attr, value)
+                if key in group_for:
+                    raise ConfError(
+                        '{}.{} {} is generated in both group "{}" and group "{}",'
+                        ' so their offsets overlap'.format(
+                            y['table'], attr, value, group_for[key], x['group']
+                        )
+                    )
+                group_for[key] = x['group']
+    return True
+
+
+def consistency_check_group_capacity(data, table_config):
+    """With per-group sequences, check that the records of each table in a
+    group fit below the offset of the next group with records of that table.
+    This is the rule that resolve_auto_offsets packs auto groups by with
+    per_group, so the ids of two groups never overlap.
+
+    It works on all the groups as they come from conf_data(), so a run of
+    only some of the groups is checked against the others too.
+
+    >>> config = {'t': {'attrs': {'id': {'seq': {'start': 100}}}},
+    ...           'u': {'attrs': {'id': {'seq': {'start': 100}}}}}
+    >>> d = [{'group': 'a', 'offset': 0, 'data': [['t x', {'repeat': 3}]]},
+    ...      {'group': 'b', 'offset': 2, 'data': [['t x']]}]
+    >>> consistency_check_group_capacity(d, config)
+    Traceback (most recent call last):
+    core.ConfError: group "a" has 3 t records, but only room for 2 before group "b" at offset 2
+
+    Groups without records of a table leave its ids to the groups before
+    them, like auto offsets packed with per_group:
+
+    >>> d = [{'group': 'a', 'offset': 'auto', 'data': [['t x', {'repeat': 5}]]},
+    ...      {'group': 'b', 'offset': 'auto', 'data': [['u x']]}]
+    >>> d, assignments = resolve_auto_offsets(d, config, per_group=True)
+    >>> assignments == {'a': 0, 'b': 1}
+    True
+    >>> consistency_check_group_capacity(d, config)
+    True
+    """
+
+    ordered = sorted(data, key=lambda x: x['offset'])
+    groups_for = collections.defaultdict(list)
+    for x in ordered:
+        for table, count in sorted(raw_table_counts(x).items()):
+            if table in table_config and attributes_needing_sequences(table_config[table]):
+                groups_for[table].append((x, count))
+
+    for table, groups in sorted(groups_for.items()):
+        for (x, count), (after, _) in zip(groups, groups[1:]):
+            room = after['offset'] - x['offset']
+            if count > room:
+                raise ConfError(
+                    'group "{}" has {} {} records, but only room for {} before group "{}"'
+                    ' at offset {}'.format(x['group'], count, table, room, after['group'],
+                                           after['offset'])
+                )
+    return True
+
+
 def consistency_check_no_same_aliases(data):
     # TODO
     return True
@@ -167,9 +703,11 @@ def consistency_check_no_same_groups(data):
 #############################################################################
 
 
-def enhance_with_generated_data(data, seq_for, config):
+def enhance_with_generated_data(data, seq_for, config, seed=0, sequence_bases=None,
+                                per_group=False):
     data = add_generated_key_and_dict(data)
-    data = enhance_with_generated_sequential_data(data, seq_for, config)
+    data = enhance_with_generated_sequential_data(data, seq_for, config, sequence_bases, per_group)
+    data = enhance_with_gen_values(data, config, seed)
 
     data = enhance_with_referenced_foreign_ids(data)
     data = enhance_with_reference_objects(data)
@@ -193,7 +731,8 @@ def add_generated_key_and_dict(data):
     return result
 
 
-def enhance_with_generated_sequential_data(data, seq_for, table_config):
+def enhance_with_generated_sequential_data(data, seq_for, table_config, sequence_bases=None,
+                                           per_group=False):
     """This enhances the data with generated ids.
 
     >>> seq_for = {}
@@ -203,14 +742,41 @@ def enhance_with_generated_sequential_data(data, seq_for, table_config):
     >>> result = enhance_with_generated_sequential_data(d, seq_for, config)
     >>> result == [{'offset': 3, 'data': [{'table': 'calls', 'generated': {'id': 303}}]}]
     True
+
+    sequence_bases gives, per group name, how many records of each table
+    came before the group.  It is used when only some groups are generated.
+
+    >>> d = [{'group': 'g', 'offset': 3, 'data': [{'table': 'calls', 'generated': {}}]}]
+    >>> result = enhance_with_generated_sequential_data(d, {}, config, {'g': {'calls': 5}})
+    >>> result[0]['data'][0]['generated']
+    {'id': 308}
+
+    With per_group, the sequences of each group start over at start + offset,
+    so adding a record to one group doesn't change the ids of the others.
+
+    >>> d = [{'group': 'a', 'offset': 0, 'data': [{'table': 'calls', 'generated': {}},
+    ...                                           {'table': 'calls', 'generated': {}}]},
+    ...      {'group': 'b', 'offset': 10, 'data': [{'table': 'calls', 'generated': {}}]}]
+    >>> result = enhance_with_generated_sequential_data(d, {}, config, per_group=True)
+    >>> [y['generated']['id'] for x in result for y in x['data']]
+    [300, 301, 310]
     """
 
     result = copy.deepcopy(data)
+    sequence_attrs_for = {}
     for x in result:
         offset = x['offset']
+        if per_group:
+            seq_for.clear()
+        if sequence_bases is not None:
+            for table, used in sequence_bases.get(x['group'], {}).items():
+                for a in attributes_needing_sequences(table_config[table]):
+                    set_sequence_usage(table, a, used, seq_for, table_config)
         for y in x['data']:
-            attribute_names = attributes_needing_sequences(table_config[y['table']])
-            for a in attribute_names:
+            table = y['table']
+            if table not in sequence_attrs_for:
+                sequence_attrs_for[table] = attributes_needing_sequences(table_config[table])
+            for a in sequence_attrs_for[table]:
                 num, seq_for = seq_for_table_attr(y['table'], a, offset, seq_for, table_config)
                 y['generated'][a] = num
 
@@ -231,7 +797,7 @@ def seq_for_table_attr(table, attribute, offset, seq_for, table_config):
         for t in table_config:
             seq_for[t] = {}
 
-    if seq_for[table].get(attribute):
+    if attribute in seq_for[table]:
         seq_for[table][attribute] = seq_for[table][attribute] + 1
     else:
         start = table_config[table]['attrs'][attribute]['seq']['start']
@@ -242,6 +808,28 @@ def seq_for_table_attr(table, attribute, offset, seq_for, table_config):
     return result_with_offset, seq_for
 
 
+def set_sequence_usage(table, attribute, used, seq_for, table_config):
+    """Put a sequence where it would be after used numbers were taken from it
+
+    >>> table_config = {'calls': {'attrs': {'id': {'seq': {'start': 300}}}}}
+    >>> set_sequence_usage('calls', 'id', 4, {}, table_config)
+    {'calls': {'id': 303}}
+    >>> set_sequence_usage('calls', 'id', 0, {'calls': {'id': 303}}, table_config)
+    {'calls': {}}
+    """
+
+    if seq_for == {}:
+        for t in table_config:
+            seq_for[t] = {}
+
+    if used > 0:
+        start = table_config[table]['attrs'][attribute]['seq']['start']
+        seq_for[table][attribute] = start + used - 1
+    else:
+        seq_for[table].pop(attribute, None)
+    return seq_for
+
+
 def attributes_needing_sequences(table_conf):
     result = []
     for attr_name in table_conf['attrs']:
@@ -257,6 +845,7 @@ def enhance_with_referenced_foreign_ids(data):
     result = copy.deepcopy(data)
     for x in result:
         group_data = x['data']
+        aliases = alias_index_for(group_data)
         for y in group_data:
             y['referenced'] = {}
             raw = y['raw']
@@ -265,7 +854,7 @@ def enhance_with_referenced_foreign_ids(data):
                 for k, v in refs.items():
                     if v[0] == '.':
                         v = point_to_alias(
-                                v, x['group'], group_data
+                                v, x['group'], group_data, aliases
                         )
                     y['referenced'][k] = v
 
@@ -278,6 +867,8 @@ def enhance_with_reference_objects(data):
     result = copy.deepcopy(data)
     for x in result:
         group_data = x['data']
+        aliases = alias_index_for(group_data)
+        resolved = {}
         for y in group_data:
             if 'referenced' not in y:
                 y['referenced'] = {}
@@ -285,18 +876,49 @@ def enhance_with_reference_objects(data):
             ref_objs = raw.get('ref_objs')
             if ref_objs:
                 for k, v in ref_objs.items():
+                    values = {}
                     for anchor in v.anchors():
-                        value = point_to_alias(
-                            anchor, x['group'], group_data
-                        )
-                        v.bind(anchor, value)
+                        if anchor not in resolved:
+                            resolved[anchor] = point_to_alias(
+                                anchor, x['group'], group_data, aliases
+                            )
+                        values[anchor] = resolved[anchor]
+                    bind_all_anchors(v, values)
                     y['referenced'][k] = v.eval()
     return result
 
 
-def point_to_alias(refstr, group_name, group_data):
+def bind_all_anchors(ref_obj, values):
+    """Bind values to a ref object, using its batch API when it has one.
+
+    Ref objects only need to match the FactureRefObj interface, so they may not
+    inherit bind_many.
+    """
+    bind_many = getattr(ref_obj, 'bind_many', None)
+    if bind_many is not None:
+        bind_many(values)
+    else:
+        for anchor, value in values.items():
+            ref_obj.bind(anchor, value)
+
+
+def alias_index_for(group_data):
+    """ Index the records of a group by alias.  The last record with an alias wins.
+
+    >>> d = [{'alias': 'p', 'generated': {'id': 1}}, {'alias': 'p', 'generated': {'id': 2}}]
+    >>> alias_index_for(d)['p']['generated']['id']
+    2
+    """
+
+    return {x['alias']: x for x in group_data}
+
+
+def point_to_alias(refstr, group_name, group_data, aliases=None):
     """ Given a refstr, get attribute value in target.
 
+    Pass an alias index from alias_index_for when resolving many refstrs in
+    the same group to avoid scanning group_data for each one.
+
     >>> d = [{'alias': 'p', 'generated': {'id': 231}}]
 
     >>> point_to_alias('.p.id', 'z', d)
@@ -327,10 +949,9 @@ def point_to_alias(refstr, group_name, group_data):
     alias = alias_and_key[1]
     key = alias_and_key[2]
 
-    record = None
-    for x in group_data:
-        if x['alias'] == alias:
-            record = x
+    if aliases is None:
+        aliases = alias_index_for(group_data)
+    record = aliases.get(alias)
 
     if record is None:
         err('refstr: alias "{}" does not exist in group "{}"'.format(
@@ -351,6 +972,160 @@ def point_to_alias(refstr, group_name, group_data):
     return new_value
 
 
+#############################################################################
+
+MASK64 = (1 << 64) - 1
+GOLDEN64 = 0x9E3779B97F4A7C15
+GEN_NUMPY_MIN_ROWS = 1000
+
+
+def enhance_with_gen_values(data, table_config, seed=0):
+    """ Fill the 'gen' layer with the values of attrs that have a 'gen' spec.
+
+    Values depend only on the seed, the group, the table, the attr and the
+    index of the record among the records of its table in its group, so they
+    are reproducible and don't change when other groups change.
+
+    >>> config = {'t': {'attrs': {'n': {'gen': {'type': 'int', 'min': 1, 'max': 6}}}}}
+    >>> d = [{'group': 'g', 'data': [{'table': 't'}, {'table': 't'}]}]
+    >>> [y['gen']['n'] for y in enhance_with_gen_values(d, config)[0]['data']]
+    [6, 6]
+    """
+
+    result = copy.deepcopy(data)
+    gen_specs_for = {}
+    for x in result:
+        records_for = collections.OrderedDict()
+        for y in x['data']:
+            y['gen'] = {}
+            records_for.setdefault(y['table'], []).append(y)
+
+        for table, records in records_for.items():
+            if table not in gen_specs_for:
+                attrs = table_config.get(table, {}).get('attrs', {})
+                gen_specs_for[table] = [(k, v['gen']) for k, v in attrs.items() if v.get('gen')]
+            for attr, spec in gen_specs_for[table]:
+                key = gen_stream_key(seed, x['group'], table, attr)
+                for y, value in zip(records, gen_values(spec, key, len(records))):
+                    y['gen'][attr] = value
+    return result
+
+
+def gen_stream_key(seed, group, table, attr):
+    name = '{}:{}:{}:{}'.format(seed, group, table, attr).encode('utf-8')
+    return int.from_bytes(hashlib.sha1(name).digest()[:8], 'little')
+
+
+def gen_hashes(key, count):
+    """ The first count outputs of the splitmix64 generator started at key.
+
+    Batches are computed with NumPy when it is installed; the values are the
+    same either way.
+
+    >>> gen_hashes(0, 2)
+    [16294208416658607535, 7960286522194355700]
+    """
+
+    if numpy is not None and count >= GEN_NUMPY_MIN_ROWS:
+        with numpy.errstate(over='ignore'):
+            z = numpy.uint64(key) + (numpy.arange(1, count + 1, dtype=numpy.uint64) *
+                                     numpy.uint64(GOLDEN64))
+            z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+            return (z ^ (z >> numpy.uint64(31))).tolist()
+
+    result = []
+    for index in range(1, count + 1):
+        z = (key + index * GOLDEN64) & MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+        result.append(z ^ (z >> 31))
+    return result
+
+
+def gen_values(spec, key, count):
+    """ Generate count values for a gen spec
+
+    >>> gen_values({'type': 'choice', 'values': ['a', 'b', 'c']}, 11, 4)
+    ['a', 'b', 'a', 'c']
+    >>> gen_values({'type': 'date', 'start': '2018-01-01', 'end': '2018-12-31'}, 7, 2)
+    ['2018-01-13', '2018-03-26']
+    >>> gen_values({'type': 'float', 'min': 1, 'max': 100, 'decimals': 2}, 7, 2)
+    [39.59, 2.66]
+    >>> gen_values({'type': 'pattern', 'pattern': 'ORD-###-??'}, 7, 2)
+    ['ORD-869-OO', 'ORD-343-TF']
+
+    >>> gen_values({'type': 'whoops'}, 7, 1)
+    Traceback (most recent call last):
+    core.ConfError: gen type 'whoops' is not one of choice, date, float, int, pattern
+    """
+
+    gen_type = spec.get('type')
+    if gen_type not in GEN_TYPES:
+        raise ConfError(
+            "gen type '{}' is not one of {}".format(gen_type, ', '.join(sorted(GEN_TYPES)))
+        )
+    return GEN_TYPES[gen_type](spec, key, count)
+
+
+def gen_int_values(spec, key, count):
+    low = spec['min']
+    span = spec['max'] - low + 1
+    return [low + h % span for h in gen_hashes(key, count)]
+
+
+def gen_float_values(spec, key, count):
+    low = spec['min']
+    width = spec['max'] - low
+    decimals = spec.get('decimals', 2)
+    return [round(low + (h >> 11) / 2 ** 53 * width, decimals) for h in gen_hashes(key, count)]
+
+
+def gen_date_values(spec, key, count):
+    start = datetime.datetime.strptime(spec['start'], '%Y-%m-%d').toordinal()
+    end = datetime.datetime.strptime(spec['end'], '%Y-%m-%d').toordinal()
+    days = end - start + 1
+    return [
+        datetime.date.fromordinal(start + h % days).isoformat()
+        for h in gen_hashes(key, count)
+    ]
+
+
+def gen_choice_values(spec, key, count):
+    values = spec['values']
+    return [values[h % len(values)] for h in gen_hashes(key, count)]
+
+
+PATTERN_ALPHABETS = {
+    '#': '0123456789',
+    '?': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+}
+
+
+def gen_pattern_values(spec, key, count):
+    """ '#' becomes a digit and '?' an uppercase letter; other characters are kept """
+
+    pattern = spec['pattern']
+    columns = []
+    for position, char in enumerate(pattern):
+        alphabet = PATTERN_ALPHABETS.get(char)
+        if alphabet is None:
+            columns.append([char] * count)
+        else:
+            hashes = gen_hashes(gen_stream_key(key, position, '', ''), count)
+            columns.append([alphabet[h % len(alphabet)] for h in hashes])
+    return [''.join(chars) for chars in zip(*columns)] if columns else [''] * count
+
+
+GEN_TYPES = {
+    'int': gen_int_values,
+    'float': gen_float_values,
+    'date': gen_date_values,
+    'choice': gen_choice_values,
+    'pattern': gen_pattern_values,
+}
+
+
 #############################################################################
 
 
@@ -370,76 +1145,334 @@ def add_table_defaults(data, my_conf_tables):
     >>> add_table_defaults(d, c)
     Traceback (most recent call last):
     core.ConfError: table "whoops" has no default attrs conf
+
+    All the records of a table share one defaults dictionary, so treat it as
+    read-only.
+
+    >>> d = [{'data': [{'table': 'calls'}, {'table': 'calls'}]}]
+    >>> result = add_table_defaults(d, c)
+    >>> result[0]['data'][0]['defaults'] is result[0]['data'][1]['defaults']
+    True
     """
 
     result = copy.deepcopy(data)
+    defaults_for = {}
     for x in result:
         for y in x['data']:
-            y['defaults'] = {}
             table = y['table']
-            table_conf = my_conf_tables.get(table)
-            if table_conf is None:
-                raise ConfError(
-                    'table "{}" has no default attrs conf'.format(table)
-                )
-            attrs = table_conf['attrs']
-            for i in attrs.items():
-                default = i[1].get('default')
-                if default:
-                    y['defaults'].update({i[0]: default})
+            if table not in defaults_for:
+                defaults_for[table] = table_defaults(table, my_conf_tables)
+            y['defaults'] = defaults_for[table]
     return result
 
 
+def table_defaults(table, my_conf_tables):
+    table_conf = my_conf_tables.get(table)
+    if table_conf is None:
+        raise ConfError(
+            'table "{}" has no default attrs conf'.format(table)
+        )
+    defaults = {}
+    attrs = table_conf['attrs']
+    for i in attrs.items():
+        default = i[1].get('default')
+        if default:
+            defaults.update({i[0]: default})
+    return defaults
+
+
 #############################################################################
 
-def careful_merge_dicts(d1, d2):
-    d1 = copy.deepcopy(d1)
-    d2 = copy.deepcopy(d2)
-    if any(d1[k] != d2[k] for k in d1.keys() & d2):
+class LayeredRecordView(collections.abc.Mapping):
+    """A read-only view over the layers of a record.  Earlier layers win.
+
+    Nothing is copied; the view only materializes when something iterates it.
+
+    >>> view = LayeredRecordView({'id': 1}, {'name': 'a'}, {'name': 'b', 'kind': 'c'})
+    >>> view['name']
+    'a'
+    >>> dict(view) == {'id': 1, 'name': 'a', 'kind': 'c'}
+    True
+    >>> len(view)
+    3
+    """
+
+    __slots__ = ('layers',)
+
+    def __init__(self, *layers):
+        self.layers = layers
+
+    def __getitem__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self.layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.layers))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+
+def check_generated_does_not_conflict(generated, lower):
+    """Generated values may only overlap lower layers when the values agree
+
+    >>> check_generated_does_not_conflict({'id': 1}, LayeredRecordView({'id': 1}))
+
+    >>> check_generated_does_not_conflict({'id': 1}, LayeredRecordView({'id': 2}))
+    Traceback (most recent call last):
+    core.ConfError: There were overlapping keys in merging dictionaries: {'id': 2}, {'id': 1}
+    """
+
+    if any(k in lower and lower[k] != v for k, v in generated.items()):
         raise ConfError(
-            'There were overlapping keys in merging dictionaries: {}, {}'.format(d1, d2)
+            'There were overlapping keys in merging dictionaries: {}, {}'.format(
+                dict(lower), generated
+            )
         )
-    else:
-        d1.update(d2)
-        return d1
 
 
 def combine_all_into_result(data):
+    """Combine the layers of each record, from highest to lowest ranking:
+    generated, attrs, referenced, gen, defaults
+
+    >>> d = [{'data': [{'raw': {'attrs': {'name': 'a'}}, 'generated': {'id': 1},
+    ...                 'referenced': {'film_id': 2}, 'gen': {'year': 3},
+    ...                 'defaults': {'name': 'b', 'year': 4}}]}]
+    >>> result = combine_all_into_result(d)
+    >>> dict(result[0]['data'][0]['combined']) == {'id': 1, 'name': 'a', 'film_id': 2, 'year': 3}
+    True
+    """
+
     result = copy.deepcopy(data)
     for x in result:
         for y in x['data']:
-            z = y['defaults']
-            z.update(y['referenced'])
-            for attr in y['raw']['attrs']:
-                z.update({attr: y['raw']['attrs'][attr]})
-            z = careful_merge_dicts(z, y['generated'])
-            y['combined'] = z
+            lower = LayeredRecordView(
+                y['raw']['attrs'], y['referenced'], y.get('gen', {}), y['defaults']
+            )
+            check_generated_does_not_conflict(y['generated'], lower)
+            y['combined'] = LayeredRecordView(y['generated'], *lower.layers)
     return result
 
 
-def add_target_info(data, tables, targets):
+def json_default(value):
+    """Used as the json.dumps default, so lazy record views are materialized
+
+    >>> json.dumps({'a': LayeredRecordView({'b': 1})}, default=json_default)
+    '{"a": {"b": 1}}'
     """
-    >>> d = [{'data': [{'table': 'products'}]}]
-    >>> tables = {'products': {'target': 'products'}}
-    >>> targets = [{ 'name': 'products', 'type': 'foo' }]
 
-    >>> result = add_target_info(d, tables, targets)
-    >>> result == [{'data': [{'table': 'products', 'target': {'name': 'products', 'type': 'foo'}}]}]
-    True
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    return str(value)
 
-    >>> d = [{'data': [{'table': 'products'}]}]
-    >>> tables = {'products': {'start_id': 1000}}
-    >>> targets = [{ 'name': 'products', 'type': 'foo' }]
 
-    >>> result = add_target_info(d, tables, targets)
-    >>> result == [{'data': [{'table': 'products', 'target': None}]}]
+class TargetBuffer:
+    """ The rendered rows of a target.  Once the rows held in memory add up to
+    more than spill_threshold characters, they are moved to a temporary file.
+
+    >>> buffer = TargetBuffer(spill_threshold=5)
+    >>> buffer.append('abc')
+    >>> buffer.append('de\\nf')
+    >>> buffer.spilled
     True
+    >>> buffer.append('g')
+    >>> len(buffer), list(buffer)
+    (3, ['abc', 'de\\nf', 'g'])
+    """
+
+    def __init__(self, spill_threshold=None):
+        self.spill_threshold = spill_threshold
+        self.rows = []
+        self.size = 0
+        self.count = 0
+        self.spill_file = None
+
+    @property
+    def spilled(self):
+        return self.spill_file is not None
+
+    def append(self, row):
+        self.rows.append(row)
+        self.size += len(row)
+        self.count += 1
+        if self.spill_threshold is not None and self.size > self.spill_threshold:
+            self.spill()
+
+    def spill(self):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+        self.spill_file.seek(0, os.SEEK_END)
+        for row in self.rows:
+            self.spill_file.write('{}\n{}'.format(len(row), row))
+        self.rows = []
+        self.size = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.spill_file is not None:
+            self.spill_file.seek(0)
+            while True:
+                length = self.spill_file.readline()
+                if not length:
+                    break
+                yield self.spill_file.read(int(length))
+        for row in self.rows:
+            yield row
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+class SortedTargetBuffer:
+    """ The rendered rows of a target with 'order': 'pk', sorted by key.
+
+    Rows come in runs that are already sorted, usually one per group and
+    table.  They are kept as runs, spilling to a temporary file past
+    spill_threshold characters, and merged when the buffer is read, so only
+    one row per run is in memory at a time.
+
+    >>> buffer = SortedTargetBuffer(spill_threshold=4)
+    >>> rows = [(110, 'a', 'g1'), (111, 'b', 'g1'), (100, 'c', 'g2'), (120, 'd', 'g2')]
+    >>> for key, row, run in rows:
+    ...     buffer.append(row, key, run)
+    >>> len(buffer), list(buffer)
+    (4, ['c', 'a', 'b', 'd'])
+    """
+
+    ROW_HEADER = struct.Struct('<qI')
+
+    def __init__(self, spill_threshold=None):
+        self.spill_threshold = spill_threshold
+        self.runs = []
+        self.run = None
+        self.size = 0
+        self.count = 0
+        self.spill_file = None
+        self.spilled_runs = []
+
+    def append(self, row, key, run=None):
+        current = self.runs[-1] if self.runs else None
+        if current is None or run != self.run or key < current[-1][0]:
+            current = []
+            self.runs.append(current)
+            self.run = run
+        current.append((key, row))
+        self.size += len(row)
+        self.count += 1
+        if self.spill_threshold is not None and self.size > self.spill_threshold:
+            self.spill()
+
+    def spill(self):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile('w+b')
+        self.spill_file.seek(0, os.SEEK_END)
+        for run in self.runs:
+            self.spilled_runs.append((self.spill_file.tell(), len(run)))
+            for key, row in run:
+                data = row.encode('utf-8')
+                self.spill_file.write(self.ROW_HEADER.pack(key, len(data)))
+                self.spill_file.write(data)
+        self.runs = []
+        self.size = 0
+
+    def spilled_run(self, offset, count):
+        # The runs share the spill file, so each read seeks to where its run is
+        for _ in range(count):
+            self.spill_file.seek(offset)
+            key, length = self.ROW_HEADER.unpack(self.spill_file.read(self.ROW_HEADER.size))
+            row = self.spill_file.read(length).decode('utf-8')
+            offset += self.ROW_HEADER.size + length
+            yield key, row
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        runs = [self.spilled_run(offset, count) for offset, count in self.spilled_runs]
+        runs += [iter(run) for run in self.runs]
+        for key, row in heapq.merge(*runs, key=lambda key_and_row: key_and_row[0]):
+            yield row
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def target_buffer_for(target, spill_threshold=None):
+    order = target.get('order')
+    if order == 'pk':
+        return SortedTargetBuffer(spill_threshold)
+    if order is not None:
+        raise ConfError("target '{}' has an unknown order '{}'. Use 'pk'".format(
+            target['name'], order
+        ))
+    return TargetBuffer(spill_threshold)
+
+
+def build_target_registry(targets, spill_threshold=None):
+    """ Index the targets by name, giving each one an empty output buffer
+
+    >>> registry = build_target_registry([{'name': 'films'}, {'name': 'roles'}])
+    >>> list(registry)
+    ['films', 'roles']
+    >>> len(registry['films']['output_values'])
+    0
+
+    >>> build_target_registry([{'name': 'films'}, {'name': 'films'}])
+    Traceback (most recent call last):
+    core.ConfError: target 'films' is defined more than once
+    """
+
+    registry = collections.OrderedDict()
+    for target in targets:
+        name = target['name']
+        if name in registry:
+            raise ConfError("target '{}' is defined more than once".format(name))
+        registry[name] = dict(target, output_values=target_buffer_for(target, spill_threshold))
+    return registry
+
+
+def add_target_info(data, tables, registry):
+    """ Give each record a handle (the name) of the target in the registry it is written to
 
     >>> d = [{'data': [{'table': 'products'}]}]
     >>> tables = {'products': {'target': 'products'}}
-    >>> targets = [{ 'name': 'typo_products', 'type': 'foo' }]
+    >>> registry = build_target_registry([{ 'name': 'products', 'type': 'foo' }])
+
+    >>> result = add_target_info(d, tables, registry)
+    >>> result == [{'data': [{'table': 'products', 'target': 'products'}]}]
+    True
 
-    >>> add_target_info(d, tables, targets)
+    >>> d = [{'data': [{'table': 'products'}]}]
+    >>> tables = {'products': {'start_id': 1000}}
+
+    >>> result = add_target_info(d, tables, registry)
+    >>> result == [{'data': [{'table': 'products', 'target': None}]}]
+    True
+
+    >>> d = [{'data': [{'table': 'products'}]}]
+    >>> tables = {'products': {'target': 'products'}}
+    >>> registry = build_target_registry([{ 'name': 'typo_products', 'type': 'foo' }])
+
+    >>> add_target_info(d, tables, registry)
     Traceback (most recent call last):
     core.ConfError: target 'products' from table 'products' does not exist
     """
@@ -450,50 +1483,265 @@ def add_target_info(data, tables, targets):
             target_name = tables[table].get('target')
 
             if target_name:
-                target = None
-                for i in targets:
-                    if i['name'] == target_name:
-                        target = i
-                if target is None:
+                if target_name not in registry:
                     raise ConfError(
                         "target '{}' from table '{}' does not exist".format(target_name, table)
                     )
-
-                y['target'] = copy.deepcopy(target)
+                if registry[target_name].get('type') == 'file':
+                    set_file_target_table(registry[target_name], table, tables)
+                y['target'] = target_name
             else:
                 y['target'] = None
     return result
 
+
+def set_file_target_table(target, table, tables):
+    """ A file target holds a complete insert statement, so it takes the rows
+    of a single table
+
+    >>> target = {'name': 'films_file', 'type': 'file'}
+    >>> set_file_target_table(target, 'films', {'films': {'attrs': {'id': {}, 'name': {}}}})
+    >>> target['table'], target['columns']
+    ('films', ['id', 'name'])
+    >>> set_file_target_table(target, 'roles', {'roles': {'attrs': {'id': {}}}})
+    Traceback (most recent call last):
+    core.ConfError: file target 'films_file' gets rows from more than one table: films, roles
+    """
+
+    if target.get('table', table) != table:
+        raise ConfError("file target '{}' gets rows from more than one table: {}, {}".format(
+            target['name'], target['table'], table
+        ))
+    target['table'] = table
+    target['columns'] = list(tables[table]['attrs'])
+    target['indexes'] = tables[table].get('indexes', {})
+
 #############################################################################
 
 
-def add_sql_output(data, conf_tables, indent=2):
+def add_sql_output(data, conf_tables, indent=2, registry=None, keep_output_sql=True):
+    """ Render each record as SQL.  When a target registry is given, each
+    rendered record is also appended to the output buffer of its target, and
+    its values are encoded for the 'dialect' of that target.
+
+    With keep_output_sql=False the rendered SQL only goes to the buffers, so
+    buffers that spill to disk are the only copy.
+    """
+
+    encoders = {}
     result = copy.deepcopy(data)
     for x in result:
         group = x['group']
         for y in x['data']:
-            attrs_ordered = collections.OrderedDict()
-            ordered_attrs = conf_tables[y['table']]['attrs']
-            if not HAS_DEFAULT_ORDERED_DICT and not isinstance(ordered_attrs, collections.OrderedDict):
-                raise ConfError(
-                    """table '{}' has unordered attrs. when using a version of python < 3.6 the attrs must be in 
-                    a collection.OrderedDict""".format(y['table'])
-                )
-            for i in list(ordered_attrs):
-                attrs_ordered[i] = y['combined'][i]
-            sql = sql_output_lines_for(group, attrs_ordered, indent)
-            y['output_sql'] = sql
+            sql = record_output_sql(group, y, conf_tables, indent, encoders, registry)
+            if keep_output_sql:
+                y['output_sql'] = sql
+            if registry is not None and y.get('target'):
+                target = registry[y['target']]
+                if target.get('order') == 'pk':
+                    key = y['generated'][primary_key_for_table(y['table'], conf_tables)]
+                    target['output_values'].append(sql, key, (group, y['table']))
+                else:
+                    target['output_values'].append(sql)
     return result
 
 
-def sql_output_lines_for(group, attrs, indent=2):
+def record_output_sql(group, record, conf_tables, indent=2, encoders=None, registry=None):
+    """ The SQL of one record.  encoders caches the ColumnEncoders of each
+    table, so pass the same dict for all the records of a run. """
+
+    table = record['table']
+    attrs_ordered = collections.OrderedDict()
+    ordered_attrs = conf_tables[table]['attrs']
+    if not HAS_DEFAULT_ORDERED_DICT and not isinstance(ordered_attrs, collections.OrderedDict):
+        raise ConfError(
+            "table '{}' has unordered attrs. when using a version of python < 3.6 the attrs"
+            " must be in a collection.OrderedDict".format(table)
+        )
+    for i in list(ordered_attrs):
+        attrs_ordered[i] = record['combined'][i]
+
+    if encoders is None:
+        encoders = {}
+    encoder = table_encoders(table, conf_tables, encoders, registry)
+    return sql_output_lines_for(group, attrs_ordered, indent, encoder)
+
+
+def table_encoders(table, conf_tables, encoders, registry=None):
+    """ The ColumnEncoders of a table for the dialect of its target, cached in encoders """
+
+    if table not in encoders:
+        encoders[table] = ColumnEncoders(
+            sql_dialect_for_table(table, conf_tables, registry or {}),
+            conf_tables[table]['attrs'],
+        )
+    return encoders[table]
+
+
+def sql_output_lines_for(group, attrs, indent=2, encoder=None):
     lines = []
     lines.append((' ' * indent) + "-- {}".format(group))
-    lines.extend(formatted_single_record_lines(attrs, indent))
+    lines.extend(formatted_single_record_lines(attrs, indent, encoder))
     return '\n'.join(lines)
 
 
-def formatted_single_record_lines(attrs, indent):
+def raw_sql_literal(value):
+    if not value.get('raw'):
+        raise ConfError(
+            "value is dict but no raw key {}".format(value)
+        )
+    return value['raw']
+
+
+def quoted_sql_string(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def quoted_mysql_string(value):
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "''"))
+
+
+def sql_datetime_literal(value):
+    return "'{}'".format(value.isoformat(' '))
+
+
+def sql_date_literal(value):
+    return "'{}'".format(value.isoformat())
+
+
+def hex_bytes_literal(value):
+    return "X'{}'".format(bytes(value).hex())
+
+
+"""
+The encoders of each SQL dialect, by Python type.  The encoder of a value is
+the one of the closest type in its mro, and dict values are always raw SQL.
+The default dialect is the Python repr that facture has always used.
+"""
+SQL_DIALECTS = {
+    'default': {
+        object: repr,
+    },
+    'postgres': {
+        bool: lambda v: 'true' if v else 'false',
+        int: repr,
+        float: repr,
+        decimal.Decimal: str,
+        str: quoted_sql_string,
+        datetime.datetime: sql_datetime_literal,
+        datetime.date: sql_date_literal,
+        bytes: lambda v: "'\\x{}'::bytea".format(v.hex()),
+        object: repr,
+    },
+    'snowflake': {
+        bool: lambda v: 'TRUE' if v else 'FALSE',
+        int: repr,
+        float: repr,
+        decimal.Decimal: str,
+        str: quoted_sql_string,
+        datetime.datetime: sql_datetime_literal,
+        datetime.date: sql_date_literal,
+        bytes: hex_bytes_literal,
+        object: repr,
+    },
+    'sqlite': {
+        bool: lambda v: '1' if v else '0',
+        int: repr,
+        float: repr,
+        decimal.Decimal: str,
+        str: quoted_sql_string,
+        datetime.datetime: sql_datetime_literal,
+        datetime.date: sql_date_literal,
+        bytes: hex_bytes_literal,
+        object: repr,
+    },
+    'mysql': {
+        bool: lambda v: '1' if v else '0',
+        int: repr,
+        float: repr,
+        decimal.Decimal: str,
+        str: quoted_mysql_string,
+        datetime.datetime: sql_datetime_literal,
+        datetime.date: sql_date_literal,
+        bytes: hex_bytes_literal,
+        object: repr,
+    },
+}
+
+
+def sql_dialect_for_table(table, conf_tables, registry):
+    target_name = conf_tables[table].get('target')
+    if target_name and target_name in registry:
+        return registry[target_name].get('dialect', 'default')
+    return 'default'
+
+
+def sql_encoder_for_type(dialect_encoders, value_type):
+    if issubclass(value_type, dict):
+        return raw_sql_literal
+    for t in value_type.__mro__:
+        if t in dialect_encoders:
+            return dialect_encoders[t]
+    return repr
+
+
+class ColumnEncoders:
+    """ Encodes the values of the columns of one table as SQL literals.
+
+    The encoder of a column is picked once, from the 'type' declared in its
+    attr conf or else from its first value that is not None, and then reused
+    for all the values of the same type.  None is always NULL.
+
+    >>> encoders = ColumnEncoders('postgres', {'paid': {}, 'at': {'type': datetime.datetime}})
+    >>> encoders.encode('paid', True), encoders.encode('paid', None), encoders.encode('paid', False)
+    ('true', 'NULL', 'false')
+    >>> encoders.encode('at', datetime.datetime(2018, 1, 2, 3, 4, 5))
+    "'2018-01-02 03:04:05'"
+    >>> ColumnEncoders('mysql').encode('name', "O'Brien \\\\ Sons")
+    "'O''Brien \\\\\\\\ Sons'"
+    >>> ColumnEncoders('sqlite').encode('data', b'\\x01\\xff')
+    "X'01ff'"
+    >>> ColumnEncoders('oracle')  # doctest: +NORMALIZE_WHITESPACE
+    Traceback (most recent call last):
+    core.ConfError: unknown sql dialect 'oracle'.
+        Use one of: default, mysql, postgres, snowflake, sqlite
+    """
+
+    def __init__(self, dialect='default', attrs=None):
+        if dialect not in SQL_DIALECTS:
+            raise ConfError("unknown sql dialect '{}'. Use one of: {}".format(
+                dialect, ', '.join(sorted(SQL_DIALECTS))
+            ))
+        self.dialect_encoders = SQL_DIALECTS[dialect]
+        self.encoders = {}
+        for column, attr in (attrs or {}).items():
+            if isinstance(attr, dict) and isinstance(attr.get('type'), type):
+                self.encoders[column] = (
+                    attr['type'], sql_encoder_for_type(self.dialect_encoders, attr['type'])
+                )
+
+    def encode(self, column, value):
+        if value is None:
+            return 'NULL'
+        value_type = type(value)
+        encoder = self.encoders.get(column)
+        if encoder is not None and encoder[0] is value_type:
+            return encoder[1](value)
+        encode = sql_encoder_for_type(self.dialect_encoders, value_type)
+        if encoder is None:
+            self.encoders[column] = (value_type, encode)
+        return encode(value)
+
+
+def sql_literal(value):
+    """ A value as a SQL literal of the default dialect """
+
+    if value is None:
+        return 'NULL'
+    return sql_encoder_for_type(SQL_DIALECTS['default'], type(value))(value)
+
+
+def formatted_single_record_lines(attrs, indent, encoder=None):
     """ Format the record data
 
     >>> attrs = collections.OrderedDict([\
@@ -517,6 +1765,8 @@ def formatted_single_record_lines(attrs, indent):
     >>> formatted_single_record_lines(attrs, 2)[0]
     '  21000010000,           -- id'
 
+    >>> formatted_single_record_lines({'deleted_at': None}, 0)
+    ['NULL  -- deleted_at']
     """
 
     with_value_str = []
@@ -524,15 +1774,10 @@ def formatted_single_record_lines(attrs, indent):
         key = i[0]
         value = i[1]
 
-        value_str = ''
-        if isinstance(value, dict):
-            if not value.get('raw'):
-                raise ConfError(
-                    "value is dict but no raw key {}".format(value)
-                )
-            value_str = value['raw']
+        if encoder is None:
+            value_str = sql_literal(value)
         else:
-            value_str = "{}".format(repr(value))
+            value_str = encoder.encode(key, value)
 
         with_value_str.append({'key': i[0], 'value': value, 'value_str': value_str})
 
@@ -590,98 +1835,410 @@ SQL_VALUES_CONF = {
     },
 }
 
-def write_to_actual_target_files(targets):
-    targets = targets_sorted_by_start_descending(targets)
-    for target in targets:
-        sql_format = SQL_VALUES_CONF[target.get('format', 'default')]
-        payload = sql_format['prefix']
-        payload += sql_format['join'].join([sql_format['value_format'].format(x) for x in target['output_values']])
-        payload += sql_format['suffix']
-        filename = target['filename']
-        start = target['positional_data_from_file']['start_line']
-        end = target['positional_data_from_file']['end_line']
-        insert_string_into_file_between_lines(payload, filename, start, end)
+def write_to_actual_target_files(targets, jobs=1, marker_cache=None):
+    """ Splice the payload of each target into its file.
 
+    Targets in different files are independent, so with jobs > 1 the files are
+    rendered and written by a pool of worker threads.  The sections of one file
+    are always spliced together by a single worker.
 
-def targets_sorted_by_start_descending(targets):
-    targets = copy.deepcopy(targets)
-    targets.sort(key=lambda x: x["positional_data_from_file"]["start_line"], reverse=True)
-    return targets
+    When a marker_cache is given, the markers of each written file are indexed
+    while it is written so the next run does not have to scan the file.
+    """
 
+    file_targets = [t for t in targets if t.get('type') in WHOLE_FILE_TARGET_TYPES]
+    sections_for = sections_by_filename(
+        t for t in targets if t.get('type') not in WHOLE_FILE_TARGET_TYPES
+    )
+    for filename, sections in sections_for.items():
+        for target in sections:
+            if target.get('compression'):
+                raise ConfError(
+                    "target '{}' is spliced into a section, so it can't be compressed."
+                    " Use 'type': 'file' instead".format(target['name'])
+                )
 
-def insert_string_into_file_between_lines(string, filename, start, end):
-    result = []
-    with open(filename, 'r') as f:
-        for index, line in enumerate(f):
-            linenum = index + 1
-            if linenum <= start:
-                result.append(line)
-            if linenum == start + 1:
-                result.append(string)
-            if linenum >= end:
-                result.append(line)
+    jobs_to_run = [(write_target_file, (target,)) for target in file_targets]
+    jobs_to_run += [
+        (write_sections_to_file, (filename, sections, marker_cache))
+        for filename, sections in sections_for.items()
+    ]
+    if jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(fn, *args) for fn, args in jobs_to_run]
+            for future in futures:
+                future.result()
+    else:
+        for fn, args in jobs_to_run:
+            fn(*args)
 
-    with open(filename, 'w') as f:
-        f.write("".join(result))
 
+def render_target_payload(target):
+    """
+    >>> render_target_payload({'output_values': ['  1', '  2']})
+    'values\\n(\\n  1\\n),\\n\\n(\\n  2\\n)\\n'
+    """
 
-def annotate_targets_with_output_values(targets, data):
-    targets = copy.deepcopy(targets)
+    return ''.join(target_payload_chunks(target))
 
-    for target in targets:
-        target['output_values'] = []
 
-    for x in data:
-        for y in x['data']:
-            target = target_with_name(targets, y['target']['name'])
-            target['output_values'].append(y['output_sql'])
+def target_payload_chunks(target):
+    return values_payload_chunks(target['output_values'], target.get('format', 'default'))
 
-    return targets
 
+def values_payload_chunks(output_values, format_name='default'):
+    """ The payload in pieces, so large payloads can be streamed """
 
-def target_with_name(targets, name):
-    for i in targets:
-        if i['name'] == name:
-            return i
-    return None
+    sql_format = SQL_VALUES_CONF[format_name]
+    yield sql_format['prefix']
+    for index, value in enumerate(output_values):
+        if index:
+            yield sql_format['join']
+        yield sql_format['value_format'].format(value)
+    yield sql_format['suffix']
 
 
-def annotate_targets_with_positional_data_from_file(targets):
-    targets = copy.deepcopy(targets)
+WHOLE_FILE_TARGET_TYPES = ('file', 'teardown')
+
+COMPRESSED_WRITERS = {
+    # mtime=0 keeps the output of unchanged data byte for byte the same
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='wb', mtime=0),
+    'bz2': lambda f: bz2.BZ2File(f, 'wb'),
+    'lzma': lambda f: lzma.LZMAFile(f, 'wb'),
+}
+
+
+def write_target_file(target):
+    """ Write a target of 'type': 'file' as a whole file, holding a complete
+    insert statement, streamed through its 'compression' if it has one.
+    Targets of 'type': 'teardown' hold their delete statements instead.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'films.sql.gz')
+    >>> write_target_file({'name': 'films', 'type': 'file', 'filename': filename,
+    ...                    'compression': 'gzip', 'table': 'films', 'columns': ['id'],
+    ...                    'output_values': ['  200 -- id']})
+    >>> print(gzip.open(filename, 'rt').read(), end='')
+    insert into films (
+      id
+    )
+    values
+    (
+      200 -- id
+    )
+    ;
+    """
+
+    compression = target.get('compression')
+    if compression and compression not in COMPRESSED_WRITERS:
+        raise ConfError("target '{}' has unknown compression '{}'. Use one of: {}".format(
+            target['name'], compression, ', '.join(sorted(COMPRESSED_WRITERS))
+        ))
+
+    filename = target['filename']
+    tmp_path = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_path, 'wb') as raw:
+        out = COMPRESSED_WRITERS[compression](raw) if compression else raw
+        try:
+            for chunk in file_target_chunks(target):
+                out.write(chunk.encode('utf-8'))
+        finally:
+            if out is not raw:
+                out.close()
+    os.replace(tmp_path, filename)
+
+
+def file_target_chunks(target):
+    if target.get('type') == 'teardown':
+        for statement in target.get('output_statements', []):
+            yield statement
+        return
+    if 'table' not in target:
+        # no table writes to this target, so there is no statement to make
+        return
+
+    def table_chunks(table):
+        return insert_statement_chunks(
+            table, target['columns'], target['output_values'], target.get('format', 'default')
+        )
+
+    if target.get('bulk_load'):
+        chunks = bulk_load_chunks(
+            target.get('dialect', 'default'),
+            [[target['table']]],
+            table_chunks,
+            {target['table']: {'indexes': target.get('indexes', {})}},
+        )
+    else:
+        chunks = table_chunks(target['table'])
+    for chunk in chunks:
+        yield chunk
+
+
+def sections_by_filename(targets):
+    sections_for = collections.OrderedDict()
     for target in targets:
-        filename = target['filename']
+        sections_for.setdefault(target['filename'], []).append(target)
+    return sections_for
 
-        data = []
-        with open(filename, 'r') as f:
-            data = get_facture_json_data_from_file(filename, f.read())
 
-        start_line = None
-        end_line = None
+def write_sections_to_file(filename, targets, marker_cache=None, attempts=5):
+    """ Splice the payloads of all the targets in one file in a single pass.
 
-        for datum in data:
-            opts = datum['data']
-            if opts['target_name'] == target['name'] and opts['position'] == 'start':
-                start_line = datum['linenum']
+    The payloads are streamed into a temporary file next to the original,
+    which then replaces it.  Concurrent runs take turns through an advisory
+    lock on a hidden lock file next to the target file.  Under the lock, the
+    markers are checked where annotate_targets_with_positional_data_from_file
+    found them, and looked up again if they moved.  If the file changes while
+    it is being written, by a writer that doesn't take the lock, the write is
+    tried again.
+    """
 
-        for datum in data:
-            opts = datum['data']
-            if opts['target_name'] == target['name'] and opts['position'] == 'end':
-                end_line = datum['linenum']
+    with target_file_lock(filename):
+        for _ in range(attempts):
+            with open(filename, 'rb') as f:
+                content = f.read()
+                stat = os.fstat(f.fileno())
+
+            if not markers_are_in_place(content, targets):
+                markers = get_facture_json_data_from_file(filename, content)
+                targets = [
+                    dict(
+                        t,
+                        positional_data_from_file=positional_data_for_target(t['name'], markers),
+                    )
+                    for t in targets
+                ]
 
-        if not start_line:
-            raise ConfError(
-                "could not find a start for target {}".format(target['name'])
-            )
+            tmp_path = '{}.tmp{}'.format(filename, os.getpid())
+            entry = splice_sections_into_file(filename, tmp_path, content, targets)
 
-        if not end_line:
+            now = os.stat(filename)
+            if (now.st_size, now.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                break
+            os.remove(tmp_path)
+        else:
             raise ConfError(
-                "could not find an end for target {}".format(target['name'])
+                "could not write {}: it kept changing while it was being written".format(filename)
             )
 
-        target['positional_data_from_file'] = {'start_line': start_line, 'end_line': end_line}
+        shutil.copymode(filename, tmp_path)
+        os.replace(tmp_path, filename)
+
+    if marker_cache is not None:
+        stat = os.stat(filename)
+        entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        marker_cache[os.path.abspath(filename)] = entry
+
+
+@contextlib.contextmanager
+def target_file_lock(filename):
+    """ An exclusive advisory lock for writing filename.  Where fcntl isn't
+    available, writes are not locked. """
+
+    if fcntl is None:
+        yield
+        return
+    directory, basename = os.path.split(os.path.abspath(filename))
+    lock_path = os.path.join(directory, '.{}.facture-lock'.format(basename))
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def markers_are_in_place(content, targets):
+    """ Whether the start and end markers of each target are still on the
+    lines at their recorded offsets
+
+    >>> content = b'a\\n-- facture_json: {"target_name": "t", "position": "start"}\\nold\\n' \\
+    ...           b'-- facture_json: {"target_name": "t", "position": "end"}\\n'
+    >>> position = {'start_line': 2, 'end_line': 4, 'start_offset': 2, 'end_offset': 65}
+    >>> targets = [{'name': 't', 'positional_data_from_file': position}]
+    >>> markers_are_in_place(content, targets)
+    True
+    >>> markers_are_in_place(b'new\\n' + content, targets)
+    False
+    """
+
+    for target in targets:
+        position = target['positional_data_from_file']
+        for key in ('start', 'end'):
+            offset = position.get(key + '_offset')
+            if offset is None or (offset and content[offset - 1:offset] != b'\n'):
+                return False
+            line_end = content.find(b'\n', offset)
+            if line_end == -1:
+                line_end = len(content)
+            line = content[offset:line_end].decode('utf-8', 'replace')
+            if FACTURE_JSON_MARKER not in line:
+                return False
+            data = parse_facture_json_line(line, '', 0)
+            if data['target_name'] != target['name'] or data['position'] != key:
+                return False
+        if content.count(b'\n', 0, position['start_offset']) + 1 != position['start_line']:
+            return False
+        if content.count(b'\n', 0, position['end_offset']) + 1 != position['end_line']:
+            return False
+    return True
+
+
+def splice_sections_into_file(filename, out_path, content, targets):
+    """ Write content to out_path with the payloads of the targets spliced in.
+    Returns a marker cache entry, without the stat, of what was written. """
+
+    lines = lines_of_content(content)
+    targets = sorted(targets, key=lambda x: x["positional_data_from_file"]["start_line"])
+    digest = hashlib.sha1()
+    markers = []
+    linenum = 1
+    with open(out_path, 'wb') as out:
+        def emit(text):
+            data = text.encode('utf-8')
+            digest.update(data)
+            out.write(data)
+            return text.count('\n')
+
+        def emit_lines(first, last):
+            nonlocal linenum
+            for line in lines[first:last]:
+                if FACTURE_JSON_MARKER in line:
+                    data = parse_facture_json_line(line.rstrip('\n'), filename, linenum)
+                    markers.append({
+                        'filename': filename, 'linenum': linenum, 'offset': out.tell(), 'data': data
+                    })
+                linenum += emit(line)
+
+        index = 0
+        for target in targets:
+            start = target['positional_data_from_file']['start_line']
+            end = target['positional_data_from_file']['end_line']
+            emit_lines(index, start)
+            for chunk in target_payload_chunks(target):
+                linenum += emit(chunk)
+            index = end - 1
+        emit_lines(index, len(lines))
+
+    return {'sha1': digest.hexdigest(), 'markers': markers}
+
+
+def lines_of_content(content):
+    """ The lines of the content, with their line ends, split only on newlines
+    the way get_facture_json_data_from_file counts them
+
+    >>> lines_of_content(b'a\\x0cb\\r\\n\\xe2\\x80\\xa8c\\nd')
+    ['a\\x0cb\\r\\n', '\\u2028c\\n', 'd']
+    """
+
+    lines = content.split(b'\n')
+    result = [line.decode('utf-8') + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1].decode('utf-8'))
+    return result
+
+
+def annotate_targets_with_positional_data_from_file(targets, marker_cache=None):
+    targets = copy.deepcopy(targets)
+    markers_for = {}
+    for target in targets:
+        if target.get('type') in WHOLE_FILE_TARGET_TYPES:
+            continue
+        filename = target['filename']
+
+        if filename not in markers_for:
+            markers_for[filename] = facture_markers_for_file(filename, marker_cache)
+
+        target['positional_data_from_file'] = positional_data_for_target(
+            target['name'], markers_for[filename]
+        )
     return targets
 
 
+def positional_data_for_target(target_name, markers):
+    start_line = None
+    end_line = None
+
+    for datum in markers:
+        opts = datum['data']
+        if opts['target_name'] == target_name and opts['position'] == 'start':
+            start_line = datum['linenum']
+            start_offset = datum['offset']
+
+    for datum in markers:
+        opts = datum['data']
+        if opts['target_name'] == target_name and opts['position'] == 'end':
+            end_line = datum['linenum']
+            end_offset = datum['offset']
+
+    if not start_line:
+        raise ConfError(
+            "could not find a start for target {}".format(target_name)
+        )
+
+    if not end_line:
+        raise ConfError(
+            "could not find an end for target {}".format(target_name)
+        )
+
+    return {
+        'start_line': start_line,
+        'end_line': end_line,
+        'start_offset': start_offset,
+        'end_offset': end_offset,
+    }
+
+
+def facture_markers_for_file(filename, marker_cache=None):
+    """ Find the facture_json markers in a file.
+
+    A marker_cache entry is reused without reading the file when the size and
+    mtime of the file still match, and without scanning it when the content
+    hash still matches.
+    """
+
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    entry = marker_cache.get(key) if marker_cache is not None else None
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return [dict(m, filename=filename) for m in entry['markers']]
+
+    with open(filename, 'rb') as f:
+        file_data = f.read()
+    digest = hashlib.sha1(file_data).hexdigest()
+    if entry and entry['sha1'] == digest:
+        markers = [dict(m, filename=filename) for m in entry['markers']]
+    else:
+        markers = get_facture_json_data_from_file(filename, file_data)
+
+    if marker_cache is not None:
+        marker_cache[key] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': digest,
+            'markers': markers,
+        }
+    return markers
+
+
+def load_marker_cache(path):
+    """ A missing or unreadable cache is an empty one """
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_marker_cache(path, marker_cache):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(marker_cache, f)
+    os.replace(tmp_path, path)
+
+
 def validate_facture_json_data(data):
     """
     >>> file_data = '''
@@ -773,17 +2330,37 @@ def get_facture_json_data_from_file(filename, file_data):
     'start'
     >>> res[1]['data']['position']
     'end'
+    >>> [(r['linenum'], r['offset']) for r in res]
+    [(2, 1), (4, 78)]
     """
 
+    if isinstance(file_data, str):
+        file_data = file_data.encode('utf-8')
+
+    marker = FACTURE_JSON_MARKER.encode('utf-8')
     results = []
-    for index, line in enumerate(file_data.splitlines()):
-        linenum = index + 1
+    linenum = 1
+    line_start = 0
+    position = file_data.find(marker)
+    while position != -1:
+        next_line_start = file_data.rfind(b'\n', 0, position) + 1
+        linenum += file_data.count(b'\n', line_start, next_line_start)
+        line_start = next_line_start
+        line_end = file_data.find(b'\n', position)
+        if line_end == -1:
+            line_end = len(file_data)
+        line = file_data[line_start:line_end].decode('utf-8')
         data = parse_facture_json_line(line, filename, linenum)
-        if data:
-            results.append({'filename': filename, 'linenum': linenum, 'data': data})
+        results.append(
+            {'filename': filename, 'linenum': linenum, 'offset': line_start, 'data': data}
+        )
+        position = file_data.find(marker, line_end)
     return results
 
 
+FACTURE_JSON_MARKER = 'facture_json: '
+
+
 def parse_facture_json_line(line, filename, linenum):
     """ Parse the JSON in the facture_json line
 
@@ -800,9 +2377,9 @@ def parse_facture_json_line(line, filename, linenum):
     core.ConfError: facture_json on line 34 in './foo.sql' is not valid JSON
     """
 
-    m = re.match(r'.*facture_json: (.*)', line)
-    if m:
-        json_text = m.group(1)
+    index = line.rfind(FACTURE_JSON_MARKER)
+    if index != -1:
+        json_text = line[index + len(FACTURE_JSON_MARKER):]
         result = None
         try:
             result = json.loads(json_text)
@@ -814,3 +2391,966 @@ def parse_facture_json_line(line, filename, linenum):
     else:
         return None
 
+
+#############################################################################
+
+
+def table_dependencies(data):
+    """ Find the tables each table references through refs and ref_objs
+
+    >>> d = normalize_structure([{'group': 'g', 'data': [
+    ...     ['films f'],
+    ...     ['actors a'],
+    ...     ['roles r', {'refs': {'actor_id': '.a.id', 'film_id': '.f.id', 'note': 'x'}}]
+    ... ]}])
+    >>> table_dependencies(d) == {'films': set(), 'actors': set(), 'roles': {'actors', 'films'}}
+    True
+    """
+
+    dependencies = collections.OrderedDict()
+    for x in data:
+        table_for_alias = {y['alias']: y['table'] for y in x['data']}
+        for y in x['data']:
+            depends_on = dependencies.setdefault(y['table'], set())
+            refstrs = [v for v in y['raw'].get('refs', {}).values() if v[0] == '.']
+            for ref_obj in y['raw'].get('ref_objs', {}).values():
+                refstrs.extend(ref_obj.anchors())
+            for refstr in refstrs:
+                alias_and_key = refstr.split('.')
+                table = table_for_alias.get(alias_and_key[1]) if len(alias_and_key) == 3 else None
+                if table is not None and table != y['table']:
+                    depends_on.add(table)
+    return dependencies
+
+
+def tables_in_fk_order(dependencies, preferred_order=()):
+    """ Order the tables so every table comes after the tables it references.
+
+    Ties are broken by preferred_order, which is usually the conf_tables order.
+
+    >>> tables_in_fk_order({'roles': {'actors', 'films'}, 'films': set(), 'actors': set()},
+    ...                    ['actors', 'films', 'roles'])
+    ['actors', 'films', 'roles']
+
+    >>> tables_in_fk_order({'a': {'b'}, 'b': {'a'}})
+    Traceback (most recent call last):
+    core.ConfError: tables have circular refs: a, b
+    """
+
+    rank = {table: index for index, table in enumerate(preferred_order)}
+    remaining = sorted(dependencies, key=lambda t: (rank.get(t, len(rank)), t))
+    known = set(dependencies)
+    result = []
+    placed = set()
+    while remaining:
+        ready = [t for t in remaining if dependencies[t] & known <= placed]
+        if not ready:
+            raise ConfError('tables have circular refs: {}'.format(', '.join(remaining)))
+        result.append(ready[0])
+        placed.add(ready[0])
+        remaining.remove(ready[0])
+    return result
+
+
+def sql_format_name_for_table(table, conf_tables, registry):
+    target_name = conf_tables[table].get('target')
+    if target_name and target_name in registry:
+        return registry[target_name].get('format', 'default')
+    return 'default'
+
+
+def standalone_insert_statement(table, columns, output_values, format_name='default', indent=2):
+    """ A complete insert statement for the rendered rows of a table
+
+    >>> print(standalone_insert_statement('films', ['id', 'name'], ['  200, -- id']), end='')
+    insert into films (
+      id,
+      name
+    )
+    values
+    (
+      200, -- id
+    )
+    ;
+    """
+
+    return ''.join(insert_statement_chunks(table, columns, output_values, format_name, indent))
+
+
+def insert_statement_chunks(table, columns, output_values, format_name='default', indent=2):
+    column_lines = ',\n'.join((' ' * indent) + c for c in columns)
+    yield 'insert into {} (\n{}\n)\n'.format(table, column_lines)
+    for chunk in values_payload_chunks(output_values, format_name):
+        yield chunk
+    yield ';\n'
+
+
+def load_script_chunks(data, conf_tables, registry=None, bulk_load=None):
+    """ A self-contained load script: one insert statement per table, with the
+    tables in FK order.  It comes in pieces so it can be streamed.
+
+    >>> import collections
+    >>> conf_tables = {'films': {'attrs': collections.OrderedDict([('id', {}), ('name', {})])},
+    ...                'roles': {'attrs': collections.OrderedDict([('id', {}), ('film_id', {})])}}
+    >>> d = normalize_structure([{'group': 'g', 'data': [
+    ...     ['roles r', {'attrs': {'id': 1}, 'refs': {'film_id': '.f.id'}}],
+    ...     ['films f', {'attrs': {'id': 2, 'name': 'Brazil'}}],
+    ... ]}])
+    >>> for y in d[0]['data']:
+    ...     y['combined'] = dict(y['raw']['attrs'], film_id=2)
+    >>> print(''.join(load_script_chunks(d, conf_tables)), end='')
+    insert into films (
+      id,
+      name
+    )
+    values
+    (
+      -- g
+      2,        -- id
+      'Brazil'  -- name
+    )
+    ;
+    <BLANKLINE>
+    insert into roles (
+      id,
+      film_id
+    )
+    values
+    (
+      -- g
+      1, -- id
+      2  -- film_id
+    )
+    ;
+    """
+
+    registry = registry or {}
+    encoders = {}
+    rows_for = collections.OrderedDict()
+    for x in data:
+        for y in x['data']:
+            sql = y.get('output_sql') or \
+                record_output_sql(x['group'], y, conf_tables, encoders=encoders, registry=registry)
+            rows_for.setdefault(y['table'], []).append(sql)
+
+    for chunk in insert_statements_in_fk_order(
+        rows_for, table_dependencies(data), conf_tables, registry, bulk_load
+    ):
+        yield chunk
+
+
+def insert_statements_in_fk_order(rows_for, dependencies, conf_tables, registry, bulk_load=None):
+    """ The insert statements of the tables in FK order.  With a bulk_load
+    dialect, they are wrapped as by bulk_load_chunks. """
+
+    order = tables_in_fk_order(dependencies, list(conf_tables))
+    tables = [t for t in order if t in rows_for]
+
+    def table_chunks(table):
+        return insert_statement_chunks(
+            table,
+            list(conf_tables[table]['attrs']),
+            rows_for[table],
+            sql_format_name_for_table(table, conf_tables, registry),
+        )
+
+    if bulk_load:
+        for chunk in bulk_load_chunks(
+            bulk_load, tables_connected_by_refs(tables, dependencies), table_chunks, conf_tables
+        ):
+            yield chunk
+        return
+
+    for index, table in enumerate(tables):
+        if index:
+            yield '\n'
+        for chunk in table_chunks(table):
+            yield chunk
+
+
+def write_group_partitions(data, conf_tables, directory, registry=None):
+    """ Write each group as its own set of files, one per table, plus a manifest.
+
+    The manifest lists the files of each group in FK order, so a test harness
+    can load only the groups it needs.  Groups are isolated by their offsets,
+    so they can be loaded independently of each other.
+    """
+
+    registry = registry or {}
+    order = tables_in_fk_order(table_dependencies(data), list(conf_tables))
+    manifest = {'table_order': order, 'groups': collections.OrderedDict()}
+
+    encoders = {}
+    for x in data:
+        group = x['group']
+        rows_for = collections.OrderedDict()
+        for y in x['data']:
+            sql = y.get('output_sql') or \
+                record_output_sql(group, y, conf_tables, encoders=encoders, registry=registry)
+            rows_for.setdefault(y['table'], []).append(sql)
+
+        group_dir = os.path.join(directory, group)
+        os.makedirs(group_dir, exist_ok=True)
+        files = []
+        for table in order:
+            if table not in rows_for:
+                continue
+            filename = os.path.join(group, '{}.sql'.format(table))
+            statement = standalone_insert_statement(
+                table,
+                list(conf_tables[table]['attrs']),
+                rows_for[table],
+                sql_format_name_for_table(table, conf_tables, registry),
+            )
+            with open(os.path.join(directory, filename), 'w') as f:
+                f.write(statement)
+            files.append({'table': table, 'filename': filename})
+        manifest['groups'][group] = {'offset': x['offset'], 'files': files}
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        f.write(json.dumps(manifest, indent=4) + '\n')
+    return manifest
+
+
+#############################################################################
+
+
+def alias_value_index(data):
+    """ Index every value of every record by "group.alias.column"
+
+    >>> d = [{'group': 'g', 'data': [{'alias': 'f', 'combined': {'id': 110, 'name': 'x'}}]}]
+    >>> alias_value_index(d)['g.f.id']
+    110
+    """
+
+    index = {}
+    for x in data:
+        prefix = x['group'] + '.'
+        for y in x['data']:
+            alias_prefix = prefix + y['alias'] + '.'
+            for column, value in y['combined'].items():
+                index[alias_prefix + column] = value
+    return index
+
+
+def generated_value_index(data):
+    """ Index the generated values (ids, etc.) of every record by "group.alias.column"
+
+    >>> d = [{'group': 'g', 'data': [{'alias': 'f', 'generated': {'id': 110}}]}]
+    >>> generated_value_index(d)
+    {'g.f.id': 110}
+    """
+
+    index = {}
+    for x in data:
+        prefix = x['group'] + '.'
+        for y in x['data']:
+            alias_prefix = prefix + y['alias'] + '.'
+            for column, value in y['generated'].items():
+                index[alias_prefix + column] = value
+    return index
+
+
+PARAMSTYLE_PLACEHOLDERS = {
+    'qmark': '?',
+    'format': '%s',
+    'pyformat': '%s',
+}
+
+
+def raw_value_parameter(raw, raw_values):
+    """ The parameter to pass for a raw value when it is not put into the SQL.
+
+    >>> raw_value_parameter('$build_id', 'literal')
+    '$build_id'
+    >>> raw_value_parameter('$build_id', {'$build_id': 42})
+    42
+    >>> raw_value_parameter('now()', {'$build_id': 42})
+    Traceback (most recent call last):
+    core.ConfError: raw value 'now()' has no entry in raw_values
+    """
+
+    if raw_values == 'literal':
+        return raw
+    if raw not in raw_values:
+        raise ConfError("raw value '{}' has no entry in raw_values".format(raw))
+    return raw_values[raw]
+
+
+def load_into_connection(connection, data, conf_tables, paramstyle='qmark', create_tables=False,
+                         raw_values='sql'):
+    """ Insert the records into a DB-API connection, batched per table in FK order.
+
+    raw_values decides what happens to raw values:
+
+    * 'sql': they are SQL expressions, put into the statement instead of
+      being passed as parameters.  Rows are batched with executemany for
+      each distinct set of raw expressions.
+    * 'literal': the raw text is passed as a string parameter.
+    * a dict: the raw text is looked up and the value passed as a parameter;
+      a raw value missing from the dict is a ConfError.
+
+    >>> import sqlite3
+    >>> conn = sqlite3.connect(':memory:')
+    >>> d = [{'group': 'g', 'data': [
+    ...     {'table': 'films', 'alias': 'f', 'raw': {},
+    ...      'combined': {'id': 110, 'year': {'raw': '1990 + 4'}}}]}]
+    >>> conf_tables = {'films': {'attrs': {'id': {}, 'year': {}}}}
+    >>> load_into_connection(conn, d, conf_tables, create_tables=True)
+    >>> load_into_connection(conn, d, conf_tables, raw_values='literal')
+    >>> load_into_connection(conn, d, conf_tables, raw_values={'1990 + 4': 1995})
+    >>> conn.execute('select id, year from films').fetchall()
+    [(110, 1994), (110, '1990 + 4'), (110, 1995)]
+    >>> load_into_connection(conn, d, conf_tables, raw_values='python')
+    Traceback (most recent call last):
+    core.ConfError: raw_values 'python' is not supported
+    """
+
+    if paramstyle not in PARAMSTYLE_PLACEHOLDERS:
+        raise ConfError("paramstyle '{}' is not supported".format(paramstyle))
+    placeholder = PARAMSTYLE_PLACEHOLDERS[paramstyle]
+    if not isinstance(raw_values, dict) and raw_values not in ('sql', 'literal'):
+        raise ConfError("raw_values '{}' is not supported".format(raw_values))
+
+    rows_for = collections.OrderedDict()
+    for x in data:
+        for y in x['data']:
+            rows_for.setdefault(y['table'], []).append(y['combined'])
+
+    cursor = connection.cursor()
+    for table in tables_in_fk_order(table_dependencies(data), list(conf_tables)):
+        columns = list(conf_tables[table]['attrs'])
+        if create_tables:
+            cursor.execute('create table if not exists {} ({})'.format(table, ', '.join(columns)))
+
+        batches = collections.OrderedDict()
+        for combined in rows_for[table]:
+            values = [combined[c] for c in columns]
+            if raw_values == 'sql':
+                raws = tuple(v['raw'] if isinstance(v, dict) else None for v in values)
+                params = [v for v in values if not isinstance(v, dict)]
+            else:
+                raws = (None,) * len(values)
+                params = [
+                    raw_value_parameter(v['raw'], raw_values) if isinstance(v, dict) else v
+                    for v in values
+                ]
+            batches.setdefault(raws, []).append(params)
+
+        for raws, params in batches.items():
+            sql = 'insert into {} ({}) values ({})'.format(
+                table,
+                ', '.join(columns),
+                ', '.join(placeholder if raw is None else raw for raw in raws),
+            )
+            cursor.executemany(sql, params)
+    connection.commit()
+
+
+#############################################################################
+
+
+def primary_key_for_table(table, conf_tables):
+    """ The first seq attr of a table identifies its rows
+
+    >>> films = {'films': {'attrs': {'name': {}, 'id': {'seq': {'start': 1}}}}}
+    >>> primary_key_for_table('films', films)
+    'id'
+    >>> primary_key_for_table('tags', {'tags': {'attrs': {'name': {}}}})
+    Traceback (most recent call last):
+    core.ConfError: table 'tags' has no seq attr to identify its rows by
+    """
+
+    for attr in attributes_needing_sequences(conf_tables[table]):
+        return attr
+    raise ConfError("table '{}' has no seq attr to identify its rows by".format(table))
+
+
+def row_state(data, conf_tables, registry=None):
+    """ The SQL literals of every row, per group, table and primary key, as
+    the load script writes them in the dialect of the table's target.  They
+    can be saved as json and compared with a later run without losing the
+    types of the values.
+
+    >>> conf_tables = {'films': {'attrs': collections.OrderedDict([
+    ...     ('id', {'seq': {'start': 1}}), ('name', {}), ('year', {})])}}
+    >>> d = [{'group': 'g', 'data': [{'table': 'films', 'alias': 'f', 'raw': {},
+    ...     'combined': {'id': 110, 'name': 'x', 'year': {'raw': '1990 + 4'}}}]}]
+    >>> state = row_state(d, conf_tables)
+    >>> state['columns'] == {'films': ['id', 'name', 'year']}
+    True
+    >>> state['groups'] == {'g': {'films': {'110': ['110', "'x'", '1990 + 4']}}}
+    True
+
+    >>> conf_tables['films']['target'] = 'films'
+    >>> d[0]['data'][0]['combined']['name'] = "O'Neil"
+    >>> state = row_state(d, conf_tables, {'films': {'dialect': 'postgres'}})
+    >>> state['groups'] == {'g': {'films': {'110': ['110', "'O''Neil'", '1990 + 4']}}}
+    True
+    """
+
+    state = {
+        'columns': {},
+        'dependencies': {
+            table: sorted(depends_on) for table, depends_on in table_dependencies(data).items()
+        },
+        'groups': collections.OrderedDict(),
+    }
+    encoders = {}
+    for x in data:
+        tables = state['groups'].setdefault(x['group'], collections.OrderedDict())
+        for y in x['data']:
+            table = y['table']
+            if table not in state['columns']:
+                state['columns'][table] = list(conf_tables[table]['attrs'])
+            columns = state['columns'][table]
+            key = primary_key_for_table(table, conf_tables)
+            encoder = table_encoders(table, conf_tables, encoders, registry)
+            values = [encoder.encode(c, y['combined'][c]) for c in columns]
+            tables.setdefault(table, collections.OrderedDict())[str(y['combined'][key])] = values
+    return state
+
+
+def load_row_state(path):
+    """ A missing state file is the state of a run without any rows """
+
+    if not os.path.isfile(path):
+        return {'columns': {}, 'dependencies': {}, 'groups': {}}
+    with open(path, 'r') as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+def save_row_state(path, state):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def merge_row_state(old_state, new_state):
+    """ The old state with the groups of new_state replaced, for runs that only
+    generate some of the groups """
+
+    groups = collections.OrderedDict(old_state['groups'])
+    groups.update(new_state['groups'])
+    return {
+        'columns': dict(old_state['columns'], **new_state['columns']),
+        'dependencies': dict(old_state.get('dependencies', {}), **new_state['dependencies']),
+        'groups': groups,
+    }
+
+
+def rows_of_state(state, group, table):
+    columns = state['columns'].get(table, [])
+    rows = state['groups'].get(group, {}).get(table, {})
+    return collections.OrderedDict(
+        (key, collections.OrderedDict(zip(columns, values))) for key, values in rows.items()
+    )
+
+
+def delta_script_chunks(old_state, new_state, conf_tables, partial=False, registry=None):
+    """ The statements that take a database loaded from old_state to new_state.
+
+    The states hold the SQL literals of the rows (see row_state), which go
+    into the statements as they are.  Rows are matched by table and primary
+    key across the compared groups.  The tables are handled in FK order: the
+    inserts and then the updates of the changed columns of each table, so
+    the rows they reference already exist.  Then come the deletes in reverse
+    FK order, after the updates that move rows off the deleted ones.
+
+    All the groups of both states are compared, so the rows of a group that
+    was removed are deleted.  With partial, only the groups of new_state are
+    compared, so a run of some of the groups leaves the others alone.
+
+    >>> conf_tables = collections.OrderedDict([
+    ...     ('films', {'attrs': collections.OrderedDict([
+    ...         ('id', {'seq': {'start': 100}}), ('name', {})])}),
+    ...     ('roles', {'attrs': collections.OrderedDict([
+    ...         ('id', {'seq': {'start': 1000}}), ('film_id', {})])})])
+    >>> columns = {'films': ['id', 'name'], 'roles': ['id', 'film_id']}
+    >>> dependencies = {'films': [], 'roles': ['films']}
+    >>> old = {'columns': columns, 'dependencies': dependencies, 'groups': {'a': {
+    ...     'films': {'100': ['100', "'Brazil'"]}, 'roles': {'1000': ['1000', '100']}}}}
+
+    Adding a film in front of Brazil shifts its id.  The new film row is
+    inserted before the role moves to it:
+
+    >>> new = {'columns': columns, 'dependencies': dependencies, 'groups': {'a': {
+    ...     'films': {'100': ['100', "'Alien'"], '101': ['101', "'Brazil'"]},
+    ...     'roles': {'1000': ['1000', '101']}}}}
+    >>> print(''.join(delta_script_chunks(old, new, conf_tables)), end='')
+    insert into films (
+      id,
+      name
+    )
+    values
+    (
+      -- a
+      101,      -- id
+      'Brazil'  -- name
+    )
+    ;
+    update films set name = 'Alien' where id = 100;
+    update roles set film_id = 101 where id = 1000;
+
+    When a group is removed, a full run deletes its rows, children first, and
+    a run of only some groups leaves them alone:
+
+    >>> only_b = dict(new, groups={'b': {}})
+    >>> print(''.join(delta_script_chunks(new, only_b, conf_tables)), end='')
+    delete from roles where id = 1000;
+    delete from films where id = 100;
+    delete from films where id = 101;
+    >>> list(delta_script_chunks(new, only_b, conf_tables, partial=True))
+    []
+    >>> list(delta_script_chunks(new, new, conf_tables))
+    []
+
+    The literals are in the dialect of each table's target, like in the load
+    script:
+
+    >>> conf_tables['films']['target'] = 'films'
+    >>> registry = {'films': {'dialect': 'postgres'}}
+    >>> d = [{'group': 'a', 'data': [{'table': 'films', 'alias': 'f', 'raw': {},
+    ...     'combined': {'id': 100, 'name': "O'Neil"}}]}]
+    >>> no_rows = {'columns': {}, 'dependencies': {}, 'groups': {}}
+    >>> oneil = row_state(d, conf_tables, registry)
+    >>> print(''.join(delta_script_chunks(no_rows, oneil, conf_tables, registry=registry)), end='')
+    insert into films (
+      id,
+      name
+    )
+    values
+    (
+      -- a
+      100,       -- id
+      'O''Neil'  -- name
+    )
+    ;
+    >>> d[0]['data'][0]['combined']['name'] = "O'Brien"
+    >>> obrien = row_state(d, conf_tables, registry)
+    >>> print(''.join(delta_script_chunks(oneil, obrien, conf_tables, registry=registry)), end='')
+    update films set name = 'O''Brien' where id = 100;
+    """
+
+    groups = list(new_state['groups'])
+    if not partial:
+        groups += [g for g in old_state['groups'] if g not in new_state['groups']]
+
+    old_rows_for = collections.OrderedDict()
+    new_rows_for = collections.OrderedDict()
+    for group in groups:
+        tables = list(old_state['groups'].get(group, {}))
+        tables += [t for t in new_state['groups'].get(group, {}) if t not in tables]
+        for table in tables:
+            old_rows = old_rows_for.setdefault(table, collections.OrderedDict())
+            new_rows = new_rows_for.setdefault(table, collections.OrderedDict())
+            old_rows.update(rows_of_state(old_state, group, table))
+            for key, row in rows_of_state(new_state, group, table).items():
+                new_rows[key] = (group, row)
+
+    dependencies = collections.OrderedDict()
+    for state in (old_state, new_state):
+        for table, depends_on in state.get('dependencies', {}).items():
+            dependencies[table] = set(depends_on)
+    for table in old_rows_for:
+        dependencies.setdefault(table, set())
+    order = [t for t in tables_in_fk_order(dependencies, list(conf_tables)) if t in old_rows_for]
+
+    for table in order:
+        key = primary_key_for_table(table, conf_tables)
+        old_rows = old_rows_for[table]
+        inserted = []
+        updates = []
+        for row_key, (group, row) in new_rows_for[table].items():
+            if row_key not in old_rows:
+                literals = collections.OrderedDict((c, {'raw': v}) for c, v in row.items())
+                inserted.append(sql_output_lines_for(group, literals))
+                continue
+            changed = collections.OrderedDict(
+                (c, v) for c, v in row.items()
+                if c not in old_rows[row_key] or old_rows[row_key][c] != v
+            )
+            if changed:
+                updates.append('update {} set {} where {} = {};\n'.format(
+                    table,
+                    ', '.join('{} = {}'.format(c, v) for c, v in changed.items()),
+                    key,
+                    row[key],
+                ))
+        if inserted:
+            for chunk in insert_statement_chunks(
+                table,
+                list(conf_tables[table]['attrs']),
+                inserted,
+                sql_format_name_for_table(table, conf_tables, registry or {}),
+            ):
+                yield chunk
+        for update in updates:
+            yield update
+
+    for table in reversed(order):
+        key = primary_key_for_table(table, conf_tables)
+        for row_key, row in old_rows_for[table].items():
+            if row_key not in new_rows_for[table]:
+                yield 'delete from {} where {} = {};\n'.format(table, key, row[key])
+
+
+#############################################################################
+
+
+def group_id_ranges(data, conf_tables):
+    """ The lowest and highest generated primary key of each table, per group
+
+    >>> conf_tables = {'films': {'attrs': {'id': {'seq': {'start': 100}}}}, 'tags': {'attrs': {}}}
+    >>> d = [{'group': 'g', 'data': [
+    ...     {'table': 'films', 'generated': {'id': 111}},
+    ...     {'table': 'films', 'generated': {'id': 110}},
+    ...     {'table': 'tags', 'generated': {}}]}]
+    >>> group_id_ranges(d, conf_tables) == {'g': {'films': (110, 111)}}
+    True
+    """
+
+    ranges = collections.OrderedDict()
+    for x in data:
+        ranges_for = ranges.setdefault(x['group'], collections.OrderedDict())
+        for y in x['data']:
+            keys = attributes_needing_sequences(conf_tables[y['table']])
+            if not keys or keys[0] not in y['generated']:
+                continue
+            value = y['generated'][keys[0]]
+            lo, hi = ranges_for.get(y['table'], (value, value))
+            ranges_for[y['table']] = (min(lo, value), max(hi, value))
+    return ranges
+
+
+def teardown_statements(data, conf_tables, patterns=None):
+    """ Range deletes that remove the generated rows of the groups, with the
+    tables in reverse FK order.  patterns are glob patterns of the groups to
+    tear down, all of them by default.
+
+    >>> conf_tables = {'films': {'attrs': {'id': {'seq': {'start': 100}}}},
+    ...                'roles': {'attrs': {'id': {'seq': {'start': 1000}}, 'film_id': {}}}}
+    >>> d = normalize_structure([{'group': 'g', 'offset': 0, 'data': [
+    ...     ['films f'], ['films f2'], ['roles r', {'refs': {'film_id': '.f.id'}}]]}])
+    >>> d = enhance_with_generated_data(d, {}, conf_tables)
+    >>> print(''.join(teardown_statements(d, conf_tables)), end='')
+    delete from roles where id between 1000 and 1000;  -- g
+    delete from films where id between 100 and 101;  -- g
+    """
+
+    order = tables_in_fk_order(table_dependencies(data), list(conf_tables))
+    ranges = group_id_ranges(data, conf_tables)
+    statements = []
+    for table in reversed(order):
+        for group, ranges_for in ranges.items():
+            if patterns and not any(fnmatch.fnmatchcase(group, p) for p in patterns):
+                continue
+            if table in ranges_for:
+                lo, hi = ranges_for[table]
+                statements.append('delete from {} where {} between {} and {};  -- {}\n'.format(
+                    table, attributes_needing_sequences(conf_tables[table])[0], lo, hi, group
+                ))
+    return statements
+
+
+def add_teardown_output(data, conf_tables, registry):
+    """ Give each target of 'type': 'teardown' its delete statements.  The
+    target's 'groups' are glob patterns of the groups it tears down. """
+
+    for target in registry.values():
+        if target.get('type') == 'teardown':
+            target['output_statements'] = teardown_statements(
+                data, conf_tables, target.get('groups')
+            )
+
+
+#############################################################################
+
+
+class SqlSink:
+    """ Writes a load script like load_script_chunks.  The rows of each table
+    are buffered, spilling to disk past spill_threshold characters, until the
+    FK order of the tables is known. """
+
+    def __init__(self, out, conf_tables, registry=None, spill_threshold=None, bulk_load=None):
+        self.out = out
+        self.conf_tables = conf_tables
+        self.registry = registry or {}
+        self.spill_threshold = spill_threshold
+        self.bulk_load = bulk_load
+        self.encoders = {}
+        self.rows_for = collections.OrderedDict()
+        self.dependencies = collections.OrderedDict()
+
+    def write_group(self, group):
+        for table, depends_on in table_dependencies([group]).items():
+            self.dependencies.setdefault(table, set()).update(depends_on)
+        for y in group['data']:
+            sql = y.get('output_sql') or record_output_sql(
+                group['group'], y, self.conf_tables, encoders=self.encoders, registry=self.registry
+            )
+            if y['table'] not in self.rows_for:
+                self.rows_for[y['table']] = TargetBuffer(self.spill_threshold)
+            self.rows_for[y['table']].append(sql)
+
+    def close(self):
+        for chunk in insert_statements_in_fk_order(
+            self.rows_for, self.dependencies, self.conf_tables, self.registry, self.bulk_load
+        ):
+            self.out.write(chunk)
+        for rows in self.rows_for.values():
+            rows.close()
+
+
+class CsvSink:
+    """ Writes one <table>.csv per table to a directory, with a header row of
+    the columns.  None is an empty field and raw values are their SQL. """
+
+    def __init__(self, directory, conf_tables):
+        self.directory = directory
+        self.conf_tables = conf_tables
+        self.files = {}
+        self.writers = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write_group(self, group):
+        for y in group['data']:
+            table = y['table']
+            writer = self.writers.get(table)
+            if writer is None:
+                f = open(os.path.join(self.directory, '{}.csv'.format(table)), 'w', newline='')
+                self.files[table] = f
+                writer = self.writers[table] = csv.writer(f)
+                writer.writerow(list(self.conf_tables[table]['attrs']))
+            combined = y['combined']
+            writer.writerow([
+                csv_field(combined[c]) for c in self.conf_tables[table]['attrs']
+            ])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def csv_field(value):
+    """
+    >>> [csv_field(v) for v in [None, {'raw': 'now()'}, 1.5, 'x']]
+    ['', 'now()', 1.5, 'x']
+    """
+
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        return raw_sql_literal(value)
+    return value
+
+
+class JsonLinesSink:
+    """ Writes one json object per record, with its group, table, alias and
+    combined values """
+
+    def __init__(self, out):
+        self.out = out
+
+    def write_group(self, group):
+        for y in group['data']:
+            self.out.write(json.dumps({
+                'group': group['group'],
+                'table': y['table'],
+                'alias': y['alias'],
+                'values': y['combined'],
+            }, sort_keys=True, default=json_default))
+            self.out.write('\n')
+
+    def close(self):
+        pass
+
+
+SINK_FORMATS = ('sql', 'csv', 'json')
+
+
+def open_sinks(specs, conf_tables, registry=None, spill_threshold=None, stdout=None,
+               bulk_load=None):
+    """ Sinks from "format:path" specs.  A path of - is stdout, except for csv,
+    whose path is a directory.  Returns the sinks and the files to close.
+
+    >>> open_sinks(['xml:out.xml'], {})
+    Traceback (most recent call last):
+    core.ConfError: sink "xml:out.xml" should be format:path with a format of sql, csv, json
+    """
+
+    sinks = []
+    files = []
+    for spec in specs:
+        format_name, _, path = spec.partition(':')
+        if format_name not in SINK_FORMATS or not path:
+            raise ConfError('sink "{}" should be format:path with a format of {}'.format(
+                spec, ', '.join(SINK_FORMATS)
+            ))
+        if format_name == 'csv':
+            sinks.append(CsvSink(path, conf_tables))
+            continue
+        if path == '-':
+            out = stdout or sys.stdout
+        else:
+            out = open(path, 'w')
+            files.append(out)
+        if format_name == 'sql':
+            sinks.append(SqlSink(out, conf_tables, registry, spill_threshold, bulk_load))
+        else:
+            sinks.append(JsonLinesSink(out))
+    return sinks, files
+
+
+def fan_out_to_sinks(data, sinks):
+    """ Hand every group to every sink in a single pass over the data, then
+    close the sinks
+
+    >>> import io
+    >>> conf_tables = {'films': {'attrs': collections.OrderedDict([('id', {}), ('name', {})])}}
+    >>> d = [{'group': 'g', 'data': [{'table': 'films', 'alias': 'f', 'raw': {},
+    ...                               'combined': {'id': 1, 'name': None}}]}]
+    >>> out = io.StringIO()
+    >>> fan_out_to_sinks(d, [JsonLinesSink(out)])
+    >>> out.getvalue()
+    '{"alias": "f", "group": "g", "table": "films", "values": {"id": 1, "name": null}}\\n'
+    """
+
+    for x in data:
+        for sink in sinks:
+            sink.write_group(x)
+    for sink in sinks:
+        sink.close()
+
+
+#############################################################################
+
+"""
+The statements that speed up a bulk load in each SQL dialect.  The run
+statements wrap the whole load.  The table statements wrap each batch of
+tables connected by refs, so their checks come back on only once all the
+tables that reference each other are loaded.  The secondary indexes of a
+table, from the 'indexes' of its conf (index name to create statement), are
+dropped before its batch and created again after it.
+"""
+BULK_LOAD_DIALECTS = {
+    'postgres': {
+        'run_preamble': ['begin;', 'set constraints all deferred;'],
+        'run_postamble': ['commit;'],
+        'table_preamble': ['alter table {table} disable trigger all;'],
+        'table_postamble': ['alter table {table} enable trigger all;'],
+        'drop_index': 'drop index if exists {index};',
+    },
+    'mysql': {
+        'run_preamble': ['set foreign_key_checks = 0;', 'set unique_checks = 0;'],
+        'run_postamble': ['set unique_checks = 1;', 'set foreign_key_checks = 1;'],
+        'table_preamble': ['alter table {table} disable keys;'],
+        'table_postamble': ['alter table {table} enable keys;'],
+        'drop_index': 'drop index {index} on {table};',
+    },
+    'sqlite': {
+        'run_preamble': ['pragma foreign_keys = off;', 'begin;'],
+        'run_postamble': ['commit;', 'pragma foreign_keys = on;'],
+        'table_preamble': [],
+        'table_postamble': [],
+        'drop_index': 'drop index if exists {index};',
+    },
+    'snowflake': {
+        # constraints are not enforced and there are no secondary indexes
+        'run_preamble': ['begin;'],
+        'run_postamble': ['commit;'],
+        'table_preamble': [],
+        'table_postamble': [],
+        'drop_index': None,
+    },
+}
+
+
+def tables_connected_by_refs(tables, dependencies):
+    """ Split the tables, which are in FK order, into batches of tables that
+    are connected through refs, keeping the order
+
+    >>> tables_connected_by_refs(['actors', 'tags', 'films', 'roles'],
+    ...                          {'roles': {'actors', 'films'}, 'tags': set()})
+    [['actors', 'films', 'roles'], ['tags']]
+    """
+
+    batch_of = {table: index for index, table in enumerate(tables)}
+    for table in tables:
+        for other in dependencies.get(table, ()):
+            if other in batch_of and batch_of[other] != batch_of[table]:
+                merged, kept = sorted((batch_of[table], batch_of[other]), reverse=True)
+                for t in tables:
+                    if batch_of[t] == merged:
+                        batch_of[t] = kept
+
+    batches = collections.OrderedDict()
+    for table in tables:
+        batches.setdefault(batch_of[table], []).append(table)
+    return list(batches.values())
+
+
+def bulk_load_chunks(dialect, batches, table_chunks, conf_tables):
+    """ The statements of table_chunks(table) for each batch of tables, wrapped
+    in the bulk load statements of the dialect
+
+    >>> index = 'create index films_name on films (name);'
+    >>> conf_tables = {'films': {'indexes': {'films_name': index}}, 'roles': {}}
+    >>> table_chunks = lambda table: ['insert into {} ...;\\n'.format(table)]
+    >>> chunks = bulk_load_chunks('postgres', [['films', 'roles']], table_chunks, conf_tables)
+    >>> print(''.join(chunks), end='')
+    begin;
+    set constraints all deferred;
+    <BLANKLINE>
+    alter table films disable trigger all;
+    drop index if exists films_name;
+    alter table roles disable trigger all;
+    <BLANKLINE>
+    insert into films ...;
+    <BLANKLINE>
+    insert into roles ...;
+    <BLANKLINE>
+    create index films_name on films (name);
+    alter table films enable trigger all;
+    alter table roles enable trigger all;
+    <BLANKLINE>
+    commit;
+
+    >>> list(bulk_load_chunks('default', [], None, {}))  # doctest: +NORMALIZE_WHITESPACE
+    Traceback (most recent call last):
+    core.ConfError: bulk loading needs a dialect of mysql, postgres, snowflake, sqlite,
+        not 'default'
+    """
+
+    if dialect not in BULK_LOAD_DIALECTS:
+        raise ConfError("bulk loading needs a dialect of {}, not '{}'".format(
+            ', '.join(sorted(BULK_LOAD_DIALECTS)), dialect
+        ))
+    wrappers = BULK_LOAD_DIALECTS[dialect]
+
+    def block(lines):
+        return ''.join(line + '\n' for line in lines) + '\n' if lines else ''
+
+    yield block(wrappers['run_preamble'])
+    for batch in batches:
+        preamble = []
+        postamble = []
+        for table in batch:
+            indexes = conf_tables.get(table, {}).get('indexes', {})
+            preamble.extend(s.format(table=table) for s in wrappers['table_preamble'])
+            if wrappers['drop_index']:
+                preamble.extend(
+                    wrappers['drop_index'].format(index=index, table=table) for index in indexes
+                )
+                postamble.extend(indexes.values())
+            postamble.extend(s.format(table=table) for s in wrappers['table_postamble'])
+        yield block(preamble)
+        for index, table in enumerate(batch):
+            if index:
+                yield '\n'
+            for chunk in table_chunks(table):
+                yield chunk
+        yield '\n'
+        yield block(postamble)
+    yield ''.join(line + '\n' for line in wrappers['run_postamble'])
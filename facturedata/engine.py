@@ -0,0 +1,328 @@
+import hashlib
+import importlib.util
+import logging
+import os
+import sys
+try:
+    from .core import *
+    from .manifest import write_id_manifest
+except ImportError:
+    from core import *
+    from manifest import write_id_manifest
+
+
+def load_conf_module(conf_dir=None):
+    """ Import the factureconf.py of conf_dir, or of the current directory.
+
+    Each conf file is imported as its own module, named after its path, so
+    several confs can be loaded in one process.  The conf dir is also put on
+    sys.path, for the modules that the conf imports.
+
+    >>> json_conf = load_conf_module('tests/examples/json_output')
+    >>> sql_conf = load_conf_module('tests/examples/sql_inject_target')
+    >>> sorted(json_conf.conf_tables()), sorted(sql_conf.conf_tables())
+    (['products', 'retailer_products', 'warehouses'], ['actors', 'films', 'roles'])
+    >>> load_conf_module('tests/examples/json_output') is json_conf
+    True
+    """
+
+    if conf_dir:
+        if not os.path.isdir(conf_dir):
+            raise ConfError("conf-dir {} does not exist".format(conf_dir))
+        conf_path = os.path.abspath(conf_dir)
+        if not os.path.isfile(os.path.join(conf_path, "factureconf.py")):
+            raise ConfError("conf-dir {} has no factureconf.py file".format(conf_dir))
+    else:
+        if not os.path.isfile("factureconf.py"):
+            raise ConfError("Either put a factureconf.py file in this directory or set --conf-dir")
+        conf_path = os.getcwd()
+
+    module_name = 'factureconf_{}'.format(hashlib.sha1(conf_path.encode('utf-8')).hexdigest())
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    if conf_path not in sys.path:
+        sys.path.insert(0, conf_path)
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(conf_path, 'factureconf.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
+
+
+class Facture:
+    """ Generates, renders and writes facture data in-process.
+
+    The conf is a module (or any object) with conf_tables, conf_data and
+    conf_targets functions.  Any of the three can also be passed on its own,
+    which overrides the one on the conf.  The tables and targets confs are
+    only evaluated once per instance, so generating again is cheap.
+
+    Instead of conf_data, the conf can have a conf_data_modules function that
+    returns the names of modules which each have a conf_data function.  They
+    are imported in order, and only as far as needed.
+
+    When groups is a list of glob patterns, only the matching groups are
+    normalized, generated and rendered.  The others are only counted, so
+    the selected groups get the same ids as in a full run.
+
+    Groups with 'offset': 'auto' are packed with offset_alignment, and their
+    offsets are kept stable across runs in the lock file at offset_lock_path.
+    It defaults to facture_offsets.lock.json next to the conf module.
+
+    By default each table has one sequence that runs through all the groups.
+    With per_group_sequences, it starts over in each group, at start + offset,
+    so a change to one group doesn't change the ids of the groups after it.
+
+    With a spill_threshold, the rendered rows of each target are moved to a
+    temporary file once they add up to more than that many characters, and
+    the records don't keep their own copy in 'output_sql'.
+
+    >>> import collections
+    >>> facture = Facture(
+    ...     conf_tables=lambda: {'films': {'attrs': collections.OrderedDict([
+    ...         ('id', {'seq': {'start': 100}}), ('name', {})])}},
+    ...     conf_data=lambda: [{'group': 'facture_group_a', 'offset': 10, 'data': [
+    ...         ['films f', {'attrs': {'name': 'Brazil'}}]]}],
+    ... )
+    >>> facture.generate()[0]['data'][0]['combined']['id']
+    110
+    >>> print(facture.data[0]['data'][0]['output_sql'])
+      -- facture_group_a
+      110,      -- id
+      'Brazil'  -- name
+
+    >>> facture.render('films')
+    Traceback (most recent call last):
+    core.ConfError: target 'films' does not exist
+    """
+
+    def __init__(self, conf=None, conf_tables=None, conf_data=None, conf_targets=None,
+                 flexible_group_names=False, marker_cache_path=None,
+                 offset_alignment=1, offset_lock_path=None, seed=0, groups=None,
+                 spill_threshold=None, per_group_sequences=False):
+        self.conf_tables_fn = conf_tables or getattr(conf, 'conf_tables')
+        self.conf_data_fn = conf_data or getattr(conf, 'conf_data', None)
+        self.conf_data_modules_fn = getattr(conf, 'conf_data_modules', None)
+        if self.conf_data_fn is None and self.conf_data_modules_fn is None:
+            raise ConfError("The conf needs either a conf_data or a conf_data_modules function")
+        self.groups = groups
+        self.spill_threshold = spill_threshold
+        self.per_group_sequences = per_group_sequences
+        self.conf_targets_fn = conf_targets or getattr(conf, 'conf_targets', list)
+        self.flexible_group_names = flexible_group_names
+        self.seed = seed
+        self.marker_cache_path = marker_cache_path
+        self.offset_alignment = offset_alignment
+        if offset_lock_path is None and getattr(conf, '__file__', None):
+            offset_lock_path = os.path.join(
+                os.path.dirname(os.path.abspath(conf.__file__)), 'facture_offsets.lock.json'
+            )
+        self.offset_lock_path = offset_lock_path
+
+        self._tables = None
+        self._targets = None
+        self._marker_cache = None
+        self._data = None
+        self._registry = None
+
+    @classmethod
+    def from_conf_dir(cls, conf_dir=None, **kwargs):
+        return cls(load_conf_module(conf_dir), **kwargs)
+
+    @property
+    def tables(self):
+        if self._tables is None:
+            self._tables = self.conf_tables_fn()
+        return self._tables
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            self._targets = self.conf_targets_fn()
+        return self._targets
+
+    @property
+    def marker_cache(self):
+        if self._marker_cache is None and self.marker_cache_path:
+            self._marker_cache = load_marker_cache(self.marker_cache_path)
+        return self._marker_cache
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.generate()
+        return self._data
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            self.generate()
+        return self._registry
+
+    def generate(self):
+        """ Run the whole pipeline on a fresh conf_data() and return the records """
+
+        logging.debug("setting up data")
+
+        d = list(expand_group_templates(self.load_conf_data()))
+
+        if any(x.get('offset') == 'auto' for x in d):
+            d = self.resolve_auto_offsets(d)
+
+        if self.per_group_sequences:
+            consistency_check_group_capacity(d, self.tables)
+
+        sequence_bases = None
+        if self.groups:
+            d, sequence_bases = select_groups(d, self.groups, self.tables)
+            if self.per_group_sequences:
+                sequence_bases = None
+
+        d = normalize_structure(d)
+
+        consistency_checks_or_immediately_die(d, flexible_group_names=self.flexible_group_names)
+
+        logging.debug("generating data")
+
+        d = enhance_with_generated_data(
+            d, {}, self.tables, self.seed, sequence_bases, self.per_group_sequences
+        )
+
+        consistency_check_no_duplicate_generated_values(d)
+
+        d = add_table_defaults(d, self.tables)
+
+        d = combine_all_into_result(d)
+
+        logging.debug("annotating with target information")
+
+        if self._registry is not None:
+            for target in self._registry.values():
+                target['output_values'].close()
+        registry = build_target_registry(self.targets, self.spill_threshold)
+        d = add_target_info(d, self.tables, registry)
+
+        logging.debug("adding sql output")
+
+        d = add_sql_output(
+            d, self.tables, registry=registry, keep_output_sql=self.spill_threshold is None
+        )
+
+        add_teardown_output(d, self.tables, registry)
+
+        self._data = d
+        self._registry = registry
+        return d
+
+    def load_conf_data(self):
+        if self.conf_data_fn is not None:
+            return self.conf_data_fn()
+
+        wanted = None
+        if self.groups and not any(c in p for p in self.groups for c in '*?['):
+            wanted = set(self.groups)
+
+        d = []
+        for module_name in self.conf_data_modules_fn():
+            logging.debug("importing conf data module %s", module_name)
+            d.extend(importlib.import_module(module_name).conf_data())
+            # Later groups can't change the ids of earlier ones, unless the
+            # packing of auto offsets has to take them into account.
+            if wanted and wanted <= set(x['group'] for x in d) \
+                    and not any(x.get('offset') == 'auto' for x in d):
+                break
+        return d
+
+    def resolve_auto_offsets(self, d):
+        logging.debug("packing auto offsets")
+        locked = {}
+        if self.offset_lock_path:
+            locked = load_offset_lock(self.offset_lock_path, self.offset_alignment)
+        d, assignments = resolve_auto_offsets(
+            d, self.tables, self.offset_alignment, locked, self.per_group_sequences
+        )
+        if self.offset_lock_path and assignments != locked:
+            save_offset_lock(self.offset_lock_path, self.offset_alignment, assignments)
+        return d
+
+    def render(self, target_name):
+        """ The payload that would be spliced into the section of a target """
+
+        if target_name not in self.registry:
+            raise ConfError("target '{}' does not exist".format(target_name))
+        return render_target_payload(self.registry[target_name])
+
+    def load_script_chunks(self, bulk_load=None):
+        """ A self-contained SQL load script of all the records, in pieces.
+        With a bulk_load dialect, it is wrapped in that dialect's statements
+        for fast bulk loads. """
+
+        return load_script_chunks(self.data, self.tables, self.registry, bulk_load)
+
+    def write_delta(self, state_path, out):
+        """ Write the statements that bring a database loaded by the run saved
+        in state_path up to date with this one, then save this run there """
+
+        old_state = load_row_state(state_path)
+        new_state = row_state(self.data, self.tables, self.registry)
+        for chunk in delta_script_chunks(
+            old_state, new_state, self.tables, partial=bool(self.groups), registry=self.registry
+        ):
+            out.write(chunk)
+        if self.groups:
+            new_state = merge_row_state(old_state, new_state)
+        save_row_state(state_path, new_state)
+
+    def write_sinks(self, specs, bulk_load=None):
+        """ Write the records to every "format:path" sink in one pass """
+
+        logging.debug("writing sinks")
+        sinks, files = open_sinks(
+            specs, self.tables, self.registry, self.spill_threshold, bulk_load=bulk_load
+        )
+        try:
+            fan_out_to_sinks(self.data, sinks)
+        finally:
+            for f in files:
+                f.close()
+
+    def write(self, jobs=1):
+        """ Splice every target into its file """
+
+        logging.debug("exporting to targets")
+        if len(self.registry) < 1:
+            raise ConfError(
+                "You have no targets specified in the conf_targets function."
+                " Use --skip-targets if that is intentional."
+            )
+
+        positions = annotate_targets_with_positional_data_from_file(self.targets, self.marker_cache)
+        for target in positions:
+            if target.get('type') in WHOLE_FILE_TARGET_TYPES:
+                continue
+            self.registry[target['name']]['positional_data_from_file'] = \
+                target['positional_data_from_file']
+
+        write_to_actual_target_files(
+            self.registry.values(), jobs=jobs, marker_cache=self.marker_cache
+        )
+
+        if self.marker_cache_path:
+            save_marker_cache(self.marker_cache_path, self.marker_cache)
+
+    def write_group_partitions(self, directory):
+        logging.debug("writing group partitions")
+        return write_group_partitions(self.data, self.tables, directory, self.registry)
+
+    def write_id_manifest(self, path):
+        """ Write the generated values to a binary manifest, if they changed """
+
+        logging.debug("writing id manifest")
+        return write_id_manifest(path, generated_value_index(self.data))
@@ -0,0 +1,147 @@
+""" A compact on-disk manifest of the generated values, for fast lookup by
+external tools.
+
+The file is little-endian and made to be read with mmap:
+
+* header, 48 bytes: the magic b'FACTMAN1', uint32 slot count (a power of
+  two), uint32 entry count, uint32 reserved, the 20 byte sha1 digest of the
+  entries, and 8 bytes of padding
+* slots, 24 bytes each: uint32 crc32 of the key, uint32 key offset, uint32
+  key length, uint32 flags (1 when the slot is used), int64 value
+* keys: the UTF-8 keys, "group.alias.column", one after the other
+
+To look up a key, start at slot crc32(key) & (slot count - 1) and probe
+linearly until the key matches or an unused slot is found.  Offsets of keys
+are relative to the start of the keys.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+try:
+    from .core import ConfError
+except ImportError:
+    from core import ConfError
+
+MAGIC = b'FACTMAN1'
+HEADER = struct.Struct('<8sIII20s8x')
+SLOT = struct.Struct('<IIIIq')
+SLOT_USED = 1
+
+
+def entries_digest(entries):
+    digest = hashlib.sha1()
+    for key in sorted(entries):
+        digest.update('{}={}\n'.format(key, entries[key]).encode('utf-8'))
+    return digest.digest()
+
+
+def write_id_manifest(path, entries):
+    """ Write the entries, a dict of "group.alias.column" to integer value.
+
+    The file is only rewritten when the entries changed.  Returns whether it
+    was written.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'ids.bin')
+    >>> write_id_manifest(path, {'facture_group_x.a_mf.id': 110, 'facture_group_x.f.id': 200})
+    True
+    >>> write_id_manifest(path, {'facture_group_x.a_mf.id': 110, 'facture_group_x.f.id': 200})
+    False
+    >>> with IdManifest(path) as ids:
+    ...     ids['facture_group_x.a_mf.id'], ids.get('facture_group_x.r.id'), len(ids)
+    (110, None, 2)
+
+    >>> write_id_manifest(path, {'facture_group_x.a_mf.name': 'Morgan'})
+    Traceback (most recent call last):
+    core.ConfError: id manifest value for "facture_group_x.a_mf.name" is not an integer: 'Morgan'
+    """
+
+    digest = entries_digest(entries)
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) == HEADER.size and HEADER.unpack(header)[0] == MAGIC \
+                and HEADER.unpack(header)[4] == digest:
+            return False
+
+    slot_count = 1
+    while slot_count < len(entries) * 2:
+        slot_count *= 2
+
+    slots = [None] * slot_count
+    keys = bytearray()
+    for key, value in entries.items():
+        if not isinstance(value, int):
+            raise ConfError(
+                'id manifest value for "{}" is not an integer: {!r}'.format(key, value)
+            )
+        key_bytes = key.encode('utf-8')
+        key_hash = zlib.crc32(key_bytes)
+        index = key_hash & (slot_count - 1)
+        while slots[index] is not None:
+            index = (index + 1) & (slot_count - 1)
+        slots[index] = SLOT.pack(key_hash, len(keys), len(key_bytes), SLOT_USED, value)
+        keys += key_bytes
+
+    empty_slot = SLOT.pack(0, 0, 0, 0, 0)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, slot_count, len(entries), 0, digest))
+        f.write(b''.join(slot or empty_slot for slot in slots))
+        f.write(keys)
+    os.replace(tmp_path, path)
+    return True
+
+
+class IdManifest:
+    """ Reads a manifest written by write_id_manifest through mmap """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._slot_count, self._entry_count, _, self.digest = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ConfError("'{}' is not a facture id manifest".format(path))
+        self._keys_start = HEADER.size + self._slot_count * SLOT.size
+
+    def get(self, key, default=None):
+        key_bytes = key.encode('utf-8')
+        key_hash = zlib.crc32(key_bytes)
+        index = key_hash & (self._slot_count - 1)
+        for _ in range(self._slot_count):
+            slot_hash, offset, length, flags, value = \
+                SLOT.unpack_from(self._mmap, HEADER.size + index * SLOT.size)
+            if not flags & SLOT_USED:
+                return default
+            if slot_hash == key_hash and length == len(key_bytes):
+                start = self._keys_start + offset
+                if self._mmap[start:start + length] == key_bytes:
+                    return value
+            index = (index + 1) & (self._slot_count - 1)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._entry_count
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
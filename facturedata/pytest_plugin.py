@@ -0,0 +1,81 @@
+""" pytest plugin that generates facture data once per test session.
+
+Set the conf dir with ``--facture-conf-dir`` or the ``facture_conf_dir`` ini
+option.  Fixtures:
+
+* ``facture``: the session's Facture engine
+* ``facture_data``: the generated records
+* ``facture_ids``: a dict from "group.alias.column" to the generated value
+* ``facture_db``: a connection with every record loaded into it
+
+``facture_db`` loads into an in-memory sqlite3 database, creating the tables.
+Override the ``facture_connection`` fixture to load into another DB-API
+connection (whose schema must already exist), and ``facture_paramstyle`` if
+its driver does not use the qmark paramstyle.
+
+Raw values are loaded as their literal text by default, since they are
+usually written for the target DB rather than for sqlite.  Override
+``facture_raw_values`` to return 'sql' to put them into the statements as SQL
+expressions, or a dict from raw text to the value to load.
+"""
+
+import sqlite3
+
+import pytest
+
+from .core import alias_value_index, load_into_connection
+from .engine import Facture
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('facture')
+    group.addoption('--facture-conf-dir', help="directory containing factureconf.py")
+    parser.addini('facture_conf_dir', "directory containing factureconf.py")
+
+
+@pytest.fixture(scope='session')
+def facture(request):
+    conf_dir = (
+        request.config.getoption('--facture-conf-dir') or request.config.getini('facture_conf_dir')
+    )
+    return Facture.from_conf_dir(conf_dir or None)
+
+
+@pytest.fixture(scope='session')
+def facture_data(facture):
+    return facture.generate()
+
+
+@pytest.fixture(scope='session')
+def facture_ids(facture_data):
+    return alias_value_index(facture_data)
+
+
+@pytest.fixture(scope='session')
+def facture_connection():
+    connection = sqlite3.connect(':memory:')
+    yield connection
+    connection.close()
+
+
+@pytest.fixture(scope='session')
+def facture_paramstyle():
+    return 'qmark'
+
+
+@pytest.fixture(scope='session')
+def facture_raw_values():
+    return 'literal'
+
+
+@pytest.fixture(scope='session')
+def facture_db(facture, facture_data, facture_connection, facture_paramstyle, facture_raw_values):
+    load_into_connection(
+        facture_connection,
+        facture_data,
+        facture.tables,
+        paramstyle=facture_paramstyle,
+        create_tables=isinstance(facture_connection, sqlite3.Connection),
+        raw_values=facture_raw_values,
+    )
+    return facture_connection
@@ -15,6 +15,9 @@ setup(
     entry_points={
         'console_scripts': [
             'facture = facturedata.__main__:main'
+        ],
+        'pytest11': [
+            'facturedata = facturedata.pytest_plugin'
         ]
     }
 )
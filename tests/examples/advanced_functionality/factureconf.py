@@ -14,7 +14,8 @@
 #       Facture is able to evaluate objects that match the `FactureRefObj`
 #       interface. The `StringRefObj` is an example of how you could create
 #       a lazily evaluated string that allows you to reference facture anchors
-#       in more complex data types.
+#       in more complex data types.  Facture ships a ready-made version of
+#       this as `facturedata.core.TemplateRefObj`.
 #
 
 import collections
@@ -0,0 +1,88 @@
+insert into products (
+  id,
+  classified_code,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod1
+  21000010000,           -- id
+  '0000001234',          -- classified_code
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod1
+  21000010001,           -- id
+  '0000001234',          -- classified_code
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod2
+  21000001002,           -- id
+  '0000001234',          -- classified_code
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
+
+insert into warehouses (
+  id,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod1
+  23000010000,           -- id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod2
+  23000001001,           -- id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
+
+insert into retailer_products (
+  id,
+  product_id,
+  retailer_id,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod1
+  22000010000,           -- id
+  21000010000,           -- product_id
+  23000010000,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod1
+  22000010001,           -- id
+  21000010001,           -- product_id
+  23000010000,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod2
+  22000001002,           -- id
+  21000001002,           -- product_id
+  23000001001,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
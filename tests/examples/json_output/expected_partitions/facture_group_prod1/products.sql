@@ -0,0 +1,23 @@
+insert into products (
+  id,
+  classified_code,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod1
+  21000010000,           -- id
+  '0000001234',          -- classified_code
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod1
+  21000010001,           -- id
+  '0000001234',          -- classified_code
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
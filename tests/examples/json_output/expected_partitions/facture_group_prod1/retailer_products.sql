@@ -0,0 +1,26 @@
+insert into retailer_products (
+  id,
+  product_id,
+  retailer_id,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod1
+  22000010000,           -- id
+  21000010000,           -- product_id
+  23000010000,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+),
+
+(
+  -- facture_group_prod1
+  22000010001,           -- id
+  21000010001,           -- product_id
+  23000010000,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
@@ -0,0 +1,17 @@
+insert into retailer_products (
+  id,
+  product_id,
+  retailer_id,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod2
+  22000001002,           -- id
+  21000001002,           -- product_id
+  23000001001,           -- retailer_id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
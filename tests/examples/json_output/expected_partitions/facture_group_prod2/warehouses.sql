@@ -0,0 +1,13 @@
+insert into warehouses (
+  id,
+  created_at,
+  updated_at
+)
+values
+(
+  -- facture_group_prod2
+  23000001001,           -- id
+  '2018-01-01 00:00:00', -- created_at
+  '2018-01-01 00:00:00'  -- updated_at
+)
+;
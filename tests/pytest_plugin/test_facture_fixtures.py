@@ -0,0 +1,17 @@
+""" Run by the Makefile with the plugin loaded against tests/examples/sql_inject_target """
+
+GROUP = 'facture_group_shawshank_redemption'
+
+
+def test_facture_ids(facture_ids):
+    assert facture_ids[GROUP + '.a_mf.id'] == 110
+    assert facture_ids[GROUP + '.f.name'] == 'Shawshank Redemption'
+
+
+def test_facture_db(facture_db, facture_ids):
+    assert facture_db.execute(
+        'select first_name, last_name, job_run_id from actors order by id'
+    ).fetchall() == [('Morgan', 'Freeman', '$build_id'), ('Tim', 'Robbins', '$build_id')]
+    assert facture_db.execute(
+        'select actor_id from roles where film_id = ? order by id', (facture_ids[GROUP + '.f.id'],)
+    ).fetchall() == [(facture_ids[GROUP + '.a_mf.id'],), (facture_ids[GROUP + '.a_tr.id'],)]